@@ -0,0 +1,170 @@
+"""Замеры хранения фигур: память на фигуру и скорость move().
+
+Сравнивает текущие Shape (строки ShapeStore) со старой раскладкой, где каждая
+фигура держала __dict__, строковый uuid и два QColor. tracemalloc видит только
+память Python, поэтому C++-часть QColor старой раскладки в замер не попадает и
+её выигрыш занижен. Строка store/batch - сдвиг тех же фигур одним вызовом
+ShapeStore.translate по номерам строк.
+
+Столбцы ShapeStore - array('d'): память на фигуру меньше, но чтение элемента
+создаёт новый float, поэтому поштучный move() медленнее legacy. Столбец
+"к legacy" показывает это отношение явно.
+
+Последней строкой печатается скорость FiguresContainer.hit_test на сцене с
+вложенными группами и число точек, где он расходится с перебором contains();
+расхождений быть не должно.
+
+    python benchmark.py --shapes 100000
+"""
+import argparse
+import gc
+import random
+import time
+import tracemalloc
+import uuid
+
+from PyQt6.QtGui import QColor
+
+import main
+
+
+class LegacyShape:
+    """Раскладка Shape до ShapeStore - только для сравнения."""
+
+    def __init__(self, x, y):
+        self._id = str(uuid.uuid4())
+        self._is_selected = False
+        self._x = x
+        self._y = y
+        self._width = 60
+        self._height = 60
+        self._color = QColor(0, 0, 255)
+        self.selection_color = QColor(255, 0, 0)
+
+    @property
+    def x(self): return self._x
+    @property
+    def y(self): return self._y
+    @property
+    def width(self): return self._width
+    @property
+    def height(self): return self._height
+
+    def move(self, dx, dy, form_width, form_height):
+        new_x = self._x + dx
+        new_y = self._y + dy
+        if 0 <= new_x <= form_width - self._width and 0 <= new_y <= form_height - self._height:
+            self._x = new_x
+            self._y = new_y
+            return True
+        return False
+
+
+def make_legacy(n):
+    return [LegacyShape(random.uniform(0, 5000), random.uniform(0, 5000)) for _ in range(n)]
+
+
+def make_current(n):
+    store = main.ShapeStore()
+    return [main.Circle(random.uniform(0, 5000), random.uniform(0, 5000), store) for _ in range(n)]
+
+
+def memory_per_shape(factory, n):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    shapes = factory(n)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del shapes
+    gc.collect()
+    return (after - before) / n
+
+
+def moves_per_second(factory, n, rounds):
+    shapes = factory(n)
+    start = time.perf_counter()
+    for i in range(rounds):
+        d = 1 if i % 2 == 0 else -1
+        for shape in shapes:
+            shape.move(d, d, 10000, 10000)
+    return n * rounds / (time.perf_counter() - start)
+
+
+def store_moves_per_second(n, rounds):
+    shapes = make_current(n)
+    rows = [s._row for s in shapes]
+    store = shapes[0].store
+    start = time.perf_counter()
+    for i in range(rounds):
+        d = 1 if i % 2 == 0 else -1
+        store.translate(rows, d, d)
+    return n * rounds / (time.perf_counter() - start)
+
+
+def make_grouped(n):
+    """Контейнер из n фигур, часть которых собрана во вложенные группы.
+
+    Первая группа - случай, где допуск попадания линии выходит за рамку
+    внутренней группы, но лежит в рамке внешней.
+    """
+    container = main.FiguresContainer()
+    line, box, top = main.Line(400, 230), main.Rectangle(400, 240), main.Circle(400, 100)
+    for shape in (line, box, top):
+        container.add(shape)
+    container.set_selection([line, box], True)
+    inner = container.group_selected()
+    container.set_selection([inner, top], True)
+    container.group_selected()
+    container.set_selection(container.get_selected(), False)
+    shapes = [main.ShapeFactory.create_shape(random.choice(['circle', 'rectangle', 'triangle', 'line']),
+                                             random.uniform(0, 1000), random.uniform(0, 700)) for _ in range(n)]
+    for shape in shapes:
+        container.add(shape)
+    for i in range(0, n - 3, 4):
+        container.set_selection(shapes[i:i + 2], True)
+        inner = container.group_selected()
+        container.set_selection([inner, shapes[i + 2]], True)
+        container.group_selected()
+        container.set_selection(container.get_selected(), False)
+    return container
+
+
+def hit_test_check(n, points):
+    container = make_grouped(n)
+    probes = [(450, 225)] + [(random.uniform(0, 1100), random.uniform(0, 800)) for _ in range(points)]
+    mismatches = 0
+    start = time.perf_counter()
+    found = [container.hit_test(x, y) for x, y in probes]
+    elapsed = time.perf_counter() - start
+    for (x, y), hits in zip(probes, found):
+        point = main.QPointF(x, y)
+        expected = [c for c in container.get_all() if c.contains(point)]
+        mismatches += set(hits) != set(expected)
+    return len(probes) / elapsed, mismatches
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shapes', type=int, default=100000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--points', type=int, default=200)
+    args = parser.parse_args()
+    random.seed(0)
+    print(f"{'layout':<12}{'bytes/shape':>14}{'moves/s':>14}{'к legacy':>10}")
+    legacy = None
+    for name, factory in (('legacy', make_legacy), ('store', make_current)):
+        mem = memory_per_shape(factory, args.shapes)
+        speed = moves_per_second(factory, args.shapes, args.rounds)
+        legacy = legacy or speed
+        print(f"{name:<12}{mem:>14.0f}{speed:>14.0f}{speed / legacy:>10.2f}")
+    speed = store_moves_per_second(args.shapes, args.rounds)
+    print(f"{'store/batch':<12}{'':>14}{speed:>14.0f}{speed / legacy:>10.2f}")
+    print("store: array('d') экономит память, но поштучный move() медленнее legacy "
+          "(чтение элемента создаёт float); пакетный сдвиг - store/batch")
+    speed, mismatches = hit_test_check(min(args.shapes, 20000), args.points)
+    print(f"hit_test: {speed:.0f} точек/с, расхождений с contains(): {mismatches}")
+
+
+if __name__ == '__main__':
+    run()
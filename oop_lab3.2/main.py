@@ -1,30 +1,177 @@
 import sys
+import os
+import io
 import json
+import bisect
 import math
+import mmap
+import multiprocessing
+import queue
+import struct
+import threading
 import uuid
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
-from PyQt6.QtGui import QPainter, QColor, QAction, QBrush, QPen
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from enum import Enum
+from typing import List, Dict, Any, Optional, Set, Tuple
+from PyQt6.QtGui import QPainter, QColor, QAction, QBrush, QPen, QPixmap, QRegion, QPolygonF
+try:
+    import numpy as np
+except ImportError:  # пакетные проверки попаданий работают и без NumPy, только медленнее
+    np = None
 from PyQt6.QtWidgets import (QMainWindow, QApplication, QWidget, QColorDialog,
-                             QToolBar, QTreeView, QFileDialog, QSplitter)
-from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex, pyqtSignal, QObject, QPointF
+                             QToolBar, QTreeView, QFileDialog, QSplitter, QRubberBand, QMessageBox,
+                             QProgressDialog)
+from PyQt6.QtCore import (Qt, QAbstractItemModel, QModelIndex, pyqtSignal, QObject, QPointF, QRect, QRectF, QLine,
+                          QTimer, QStandardPaths, QRunnable, QThreadPool)
+
+
+class ChangeKind(Enum):
+    INSERTED = 'inserted'
+    REMOVED = 'removed'
+    MOVED = 'moved'
+    RESTYLED = 'restyled'
+    SELECTION = 'selection'
+    RELINKED = 'relinked'
+
+
+class ChangeEvent:
+    """Точечное изменение документа.
+
+    rows - строки верхнего уровня: для INSERTED это новые строки компонентов по
+    возрастанию, для REMOVED - удалённые строки в порядке убывания.
+    rects - области холста, которые нужно перерисовать; None - весь холст.
+    """
+
+    def __init__(self, kind: ChangeKind, components: List['Component'], rows=(), rects=(), removed=()):
+        self.kind = kind
+        self.components = components
+        self.rows = list(rows)
+        self.rects = list(rects) if rects is not None else None
+        self.removed = list(removed)
+
+    @property
+    def ids(self) -> List[str]:
+        return [c.id for c in self.components]
 
 
 class Subject(QObject):
+    # changed - документ изменился целиком (например, загружен из файла)
     changed = pyqtSignal()
+    component_changed = pyqtSignal(object)
+
     def notify(self):
         self.changed.emit()
 
+    def notify_change(self, event: ChangeEvent):
+        self.component_changed.emit(event)
+
+
+class LevelOfDetail:
+    """Когда рисовать компоненты упрощённо. Пороги - в пикселях кадра.
+
+    Фигура, у которой обе стороны меньше min_shape, рисуется закрашенным
+    прямоугольником, а меньше пикселя - точкой. Если на 100x100 пикселей кадра
+    приходится больше dense компонентов, кадр рисуется без сглаживания. Только в
+    таком плотном или уменьшенном кадре стрелка короче min_arrow рисуется без
+    наконечника. Нулевой порог отключает упрощение.
+    """
+
+    def __init__(self, min_shape: float = 3.0, min_arrow: float = 24.0, dense: float = 40.0):
+        self.min_shape = min_shape
+        self.min_arrow = min_arrow
+        self.dense = dense
+        # пикселей устройства на единицу холста в текущем кадре
+        self.scale = 1.0
+        # порог наконечника в текущем кадре: 0 - наконечники рисуются всегда
+        self.arrow_cutoff = 0.0
+
+    def is_dense(self, count: int, width: float, height: float, scale: float = 1.0) -> bool:
+        area = width * height * scale * scale
+        return bool(self.dense) and area > 0 and count * 10000 / area > self.dense
+
+    def begin(self, painter: QPainter, count: int, width: float, height: float):
+        """Начать кадр сцены из count компонентов на холсте width x height."""
+        t = painter.worldTransform()
+        self.scale = math.sqrt(abs(t.determinant())) or 1.0
+        dense = self.is_dense(count, width, height, self.scale)
+        painter.setRenderHint(QPainter.RenderHint.Antialiasing, not dense)
+        self.arrow_cutoff = self.min_arrow if dense or self.scale < 1 else 0.0
+
+    def coarse_item(self, x: float, y: float, w: float, h: float):
+        """(рисование пачки, элемент) упрощённой фигуры; None - фигура достаточно крупная."""
+        size = max(w, h) * self.scale
+        if not self.min_shape or size >= self.min_shape:
+            return None
+        if size < 1:
+            return LevelOfDetail.draw_points, QPointF(x + w / 2, y + h / 2)
+        return LevelOfDetail.fill_rects, QRectF(x, y, w, h)
+
+    def coarse(self, painter: QPainter, shape: 'Shape') -> bool:
+        """Нарисовать слишком мелкую фигуру упрощённо; False - фигура достаточно крупная."""
+        coarse = self.coarse_item(*shape.get_bounding_rect())
+        if coarse is None:
+            return False
+        draw, item = coarse
+        painter.setPen(QPen(shape.selection_color if shape.is_selected else shape.color, 0))
+        draw(painter, [item])
+        return True
+
+    # рисование пачек упрощённых фигур цветом текущего пера
+    @staticmethod
+    def draw_points(painter: QPainter, items: list):
+        painter.drawPoints(items)
+
+    @staticmethod
+    def fill_rects(painter: QPainter, items: list):
+        painter.setBrush(painter.pen().color())
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.drawRects(items)
+        painter.setBrush(Qt.BrushStyle.NoBrush)
+
 
 class Component(ABC):
+    __slots__ = ('_id', '_is_selected', '_parent', '__weakref__')
+    # запас вокруг рамки под толщину пера и пунктир выделения
+    PAINT_MARGIN = 8
+    # общая для всех компонентов политика упрощённой отрисовки
+    detail = LevelOfDetail()
+
     def __init__(self):
-        self._id = str(uuid.uuid4())
+        # uuid создаётся только при первом обращении к id
+        self._id: Optional[str] = None
         self._is_selected = False
+        # группа, в которую компонент вложен
+        self._parent: Optional['Group'] = None
+
+    def _changed(self):
+        """Рамка компонента изменилась - кэшированные рамки групп-предков устарели."""
+        if self._parent is not None:
+            self._parent._invalidate()
+
+    def _rehome(self, store: 'ShapeStore'):
+        """Переносит строки листьев компонента в store (у стрелок строк нет)."""
 
     @property
     def id(self):
+        if self._id is None:
+            self._id = str(uuid.uuid4())
         return self._id
 
+    def settle(self):
+        """Заполняет ленивые поля: id и рамки групп.
+
+        После этого save() и запись документа только читают компонент, поэтому
+        их можно звать из рабочего потока.
+        """
+        self.id
+
+    def _load_id(self, data: Dict[str, Any]):
+        if 'id' in data:
+            self._id = data['id']
+
     @property
     def is_selected(self) -> bool:
         return self._is_selected
@@ -35,6 +182,16 @@ class Component(ABC):
 
     @abstractmethod
     def draw(self, painter: QPainter): pass
+
+    @staticmethod
+    def draw_outlines(painter: QPainter, color: QColor, width, style, ellipse, *rects):
+        """Пунктиры выделения одним пером: эллипсы или прямоугольники."""
+        painter.setPen(QPen(color, width, style))
+        if ellipse:
+            for rect in rects:
+                painter.drawEllipse(rect)
+        else:
+            painter.drawRects(rects)
     @abstractmethod
     def contains(self, point) -> bool: pass
     @abstractmethod
@@ -45,12 +202,37 @@ class Component(ABC):
     def adjust_to_bounds(self, form_width: float, form_height: float): pass
     @abstractmethod
     def get_bounding_rect(self) -> tuple: pass
+
+    def get_paint_rect(self) -> tuple:
+        x, y, w, h = self.get_bounding_rect()
+        m = self.PAINT_MARGIN
+        return (x - m, y - m, w + 2 * m, h + 2 * m)
     @abstractmethod
     def save(self) -> Dict[str, Any]: pass
     @abstractmethod
+    def freeze(self) -> tuple:
+        """Данные save() кортежем, первым - класс; дешевле save() и только читает компонент."""
+
+    @staticmethod
+    def thaw(frozen: tuple) -> Dict[str, Any]:
+        """Запись save() из кортежа freeze().
+
+        Компонент уже не нужен, поэтому запись можно собрать в другом потоке,
+        пока GUI правит документ.
+        """
+        return frozen[0]._record(frozen)
+    @abstractmethod
     def load(self, data: Dict[str, Any]): pass
     @abstractmethod
     def get_children(self) -> List['Component']: pass
+
+    def child_count(self) -> int:
+        """Число потомков без копии списка (см. get_children())."""
+        return 0
+
+    def children_slice(self, start: int, stop: int) -> List['Component']:
+        """Потомки с start по stop без копии всего списка."""
+        return []
     @abstractmethod
     def get_type_name(self) -> str: pass
     @abstractmethod
@@ -70,66 +252,261 @@ class Component(ABC):
     def height(self): pass
 
 
+class ShapeStore:
+    """Геометрия, цвет и вид фигур одного документа в параллельных столбцах, по строке на фигуру.
+
+    Хранилище своё у каждого FiguresContainer; фигура вне документа держит
+    строку в собственном хранилище и переезжает в хранилище контейнера при
+    вставке, а при удалении - обратно в отдельное (move_to). Освобождённые
+    строки переиспользуются; у свободной строки kind == -1.
+
+    Столбцы - типизированные array: 8 байт на координату вместо ссылки и
+    отдельного float. За это платит поштучный доступ: чтение элемента
+    создаёт новый float, и move() одной фигуры медленнее, чем со старыми
+    атрибутами (см. benchmark.py). Пакетные операции над набором строк
+    (translate, scale, snapshot, restore) идут одним проходом NumPy по тем же
+    буферам. Для векторных предикатов (hits_point, inside_rect) собираются
+    массивы NumPy, они живут до следующей записи в столбцы (arrays = None).
+    """
+    GEOMETRY = ('xs', 'ys', 'ws', 'hs')
+    COLOR = ('colors',)
+
+    def __init__(self):
+        self.xs = array('d')
+        self.ys = array('d')
+        self.ws = array('d')
+        self.hs = array('d')
+        self.colors = array('I')
+        self.kinds = array('b')
+        self._free: List[int] = []
+        self.arrays = None
+
+    def allocate(self, kind: int, x, y, w, h, color: int) -> int:
+        self.arrays = None
+        if self._free:
+            row = self._free.pop()
+            self.xs[row], self.ys[row], self.ws[row], self.hs[row] = x, y, w, h
+            self.colors[row] = color
+            self.kinds[row] = kind
+            return row
+        self.xs.append(x)
+        self.ys.append(y)
+        self.ws.append(w)
+        self.hs.append(h)
+        self.colors.append(color)
+        self.kinds.append(kind)
+        return len(self.kinds) - 1
+
+    def release(self, row: int):
+        self.arrays = None
+        self.kinds[row] = -1
+        self._free.append(row)
+
+    @staticmethod
+    def move_to(leaves: List['Shape'], store: 'ShapeStore') -> bool:
+        """Переносит строки листьев в store и освобождает прежние; False - переносить было нечего."""
+        moved = False
+        for leaf in leaves:
+            old, r = leaf.store, leaf._row
+            if old is store:
+                continue
+            leaf._row = store.allocate(old.kinds[r], old.xs[r], old.ys[r], old.ws[r], old.hs[r], old.colors[r])
+            leaf.store = store
+            old.release(r)
+            moved = True
+        return moved
+
+    @staticmethod
+    def _view(col) -> np.ndarray:
+        """Массив NumPy поверх буфера столбца, без копии.
+
+        Пока представление живо, array не может расти (BufferError), поэтому
+        оно не должно переживать вызов, в котором создано.
+        """
+        return np.frombuffer(col, dtype=col.typecode)
+
+    def translate(self, rows, dx, dy):
+        """Сдвиг набора строк одним проходом NumPy, без проверок границ."""
+        self.arrays = None
+        rows = np.asarray(rows, dtype=np.intp)
+        self._view(self.xs)[rows] += dx
+        self._view(self.ys)[rows] += dy
+
+    def scale(self, rows, ox, oy, sx, sy):
+        """Масштабирование набора строк относительно точки (ox, oy)."""
+        self.arrays = None
+        rows = np.asarray(rows, dtype=np.intp)
+        xs, ys, ws, hs = (self._view(col) for col in (self.xs, self.ys, self.ws, self.hs))
+        xs[rows] = ox + (xs[rows] - ox) * sx
+        ys[rows] = oy + (ys[rows] - oy) * sy
+        ws[rows] *= sx
+        hs[rows] *= sy
+
+    def snapshot(self, rows, columns=GEOMETRY):
+        """Копия столбцов для набора строк, см. restore()."""
+        rows = np.asarray(rows, dtype=np.intp)
+        return tuple(self._view(getattr(self, name))[rows] for name in columns)
+
+    def restore(self, rows, saved, columns=GEOMETRY):
+        self.arrays = None
+        rows = np.asarray(rows, dtype=np.intp)
+        for name, values in zip(columns, saved):
+            self._view(getattr(self, name))[rows] = values
+
+    def _columns(self, rows):
+        if self.arrays is None:
+            self.arrays = (np.array(self.kinds, dtype=np.int8), np.array(self.xs, dtype=np.float64),
+                           np.array(self.ys, dtype=np.float64), np.array(self.ws, dtype=np.float64),
+                           np.array(self.hs, dtype=np.float64))
+        return tuple(col[rows] for col in self.arrays)
+
+    def hits_point(self, rows, px, py):
+        """Маска строк, чья фигура содержит точку; те же условия, что в contains()."""
+        kinds, xs, ys, ws, hs = self._columns(rows)
+        cx = xs + ws / 2
+        cy = ys + hs / 2
+        r = np.minimum(ws, hs) / 2
+        circle = (kinds == Circle.KIND) & ((px - cx) ** 2 + (py - cy) ** 2 <= r * r)
+        rect = (kinds == Rectangle.KIND) & (xs <= px) & (px <= xs + ws) & (ys <= py) & (py <= ys + hs)
+        x1, y1 = cx, ys
+        x2, y2 = xs, ys + hs
+        x3, y3 = xs + ws, ys + hs
+        d1 = (px - x2) * (y1 - y2) - (x1 - x2) * (py - y2)
+        d2 = (px - x3) * (y2 - y3) - (x2 - x3) * (py - y3)
+        d3 = (px - x1) * (y3 - y1) - (x3 - x1) * (py - y1)
+        has_neg = (d1 < 0) | (d2 < 0) | (d3 < 0)
+        has_pos = (d1 > 0) | (d2 > 0) | (d3 > 0)
+        triangle = (kinds == Triangle.KIND) & ~(has_neg & has_pos)
+        line = (kinds == Line.KIND) & (xs - 10 <= px) & (px <= xs + ws + 10) & (np.abs(py - ys) <= 15)
+        return circle | rect | triangle | line
+
+    def inside_rect(self, rows, x0, y0, x1, y1):
+        """Маска строк, чья фигура целиком лежит в прямоугольнике (у линии высота - толщина пера)."""
+        kinds, xs, ys, ws, hs = self._columns(rows)
+        hs = np.where(kinds == Line.KIND, 0, hs)
+        return (x0 <= xs) & (xs + ws <= x1) & (y0 <= ys) & (ys + hs <= y1)
+
+    def __len__(self):
+        return len(self.kinds)
+
+
 class Shape(Component):
-    def __init__(self, x, y):
+    """Представление строки ShapeStore: сам объект хранит только id, выделение, хранилище и номер строки."""
+    __slots__ = ('store', '_row')
+    KIND = -1
+    DEFAULT_SIZE = (60, 60)
+    DEFAULT_COLOR = QColor(0, 0, 255).rgba()
+    selection_color = QColor(255, 0, 0)
+
+    def __init__(self, x, y, store: Optional[ShapeStore] = None):
         super().__init__()
-        self._x = x
-        self._y = y
-        self._width = 60
-        self._height = 60
-        self._color = QColor(0, 0, 255)
-        self.selection_color = QColor(255, 0, 0)
+        w, h = self.DEFAULT_SIZE
+        self.store = store if store is not None else ShapeStore()
+        self._row = self.store.allocate(self.KIND, x, y, w, h, self.DEFAULT_COLOR)
 
     @property
-    def x(self): return self._x
+    def x(self): return self.store.xs[self._row]
     @x.setter
-    def x(self, value): self._x = value
+    def x(self, value):
+        self.store.xs[self._row] = value
+        self.store.arrays = None
     @property
-    def y(self): return self._y
+    def y(self): return self.store.ys[self._row]
     @y.setter
-    def y(self, value): self._y = value
+    def y(self, value):
+        self.store.ys[self._row] = value
+        self.store.arrays = None
     @property
-    def width(self): return self._width
+    def width(self): return self.store.ws[self._row]
     @width.setter
     def width(self, value):
-        if value > 0: self._width = value
+        if value > 0:
+            self.store.ws[self._row] = value
+            self.store.arrays = None
     @property
-    def height(self): return self._height
+    def height(self): return self.store.hs[self._row]
     @height.setter
     def height(self, value):
-        if value > 0: self._height = value
+        if value > 0:
+            self.store.hs[self._row] = value
+            self.store.arrays = None
+
+    @property
+    def color(self) -> QColor:
+        return QColor.fromRgba(self.store.colors[self._row])
 
     def set_color(self, color: QColor):
-        self._color = color
+        self.store.colors[self._row] = color.rgba()
 
     def move(self, dx, dy, form_width, form_height):
-        new_x = self._x + dx
-        new_y = self._y + dy
-        if 0 <= new_x <= form_width - self._width and 0 <= new_y <= form_height - self._height:
-            self._x = new_x
-            self._y = new_y
+        st, r = self.store, self._row
+        new_x = st.xs[r] + dx
+        new_y = st.ys[r] + dy
+        if 0 <= new_x <= form_width - st.ws[r] and 0 <= new_y <= form_height - st.hs[r]:
+            st.xs[r] = new_x
+            st.ys[r] = new_y
+            st.arrays = None
+            self._changed()
             return True
         return False
 
     def resize_shape(self, dw, dh, form_width, form_height):
-        new_width = max(20, self._width + dw)
-        new_height = max(20, self._height + dh)
-        if self._x + new_width <= form_width and self._y + new_height <= form_height:
-            self._width = new_width
-            self._height = new_height
+        st, r = self.store, self._row
+        new_width = max(20, st.ws[r] + dw)
+        new_height = max(20, st.hs[r] + dh)
+        if st.xs[r] + new_width <= form_width and st.ys[r] + new_height <= form_height:
+            st.ws[r] = new_width
+            st.hs[r] = new_height
+            st.arrays = None
+            self._changed()
             return True
         return False
 
     def adjust_to_bounds(self, form_width, form_height):
-        if self._x < 0: self._x = 0
-        if self._y < 0: self._y = 0
-        if self._x + self._width > form_width:
-            self._x = max(0, form_width - self._width)
-        if self._y + self._height > form_height:
-            self._y = max(0, form_height - self._height)
+        st, r = self.store, self._row
+        if st.xs[r] < 0: st.xs[r] = 0
+        if st.ys[r] < 0: st.ys[r] = 0
+        if st.xs[r] + st.ws[r] > form_width:
+            st.xs[r] = max(0, form_width - st.ws[r])
+        if st.ys[r] + st.hs[r] > form_height:
+            st.ys[r] = max(0, form_height - st.hs[r])
+        st.arrays = None
+        self._changed()
 
     def get_bounding_rect(self):
-        return (self._x, self._y, self._width, self._height)
+        st, r = self.store, self._row
+        return (st.xs[r], st.ys[r], st.ws[r], st.hs[r])
+
+    def _rehome(self, store: ShapeStore):
+        ShapeStore.move_to([self], store)
+
+    def draw(self, painter):
+        if self.detail.min_shape and self.detail.coarse(painter, self):
+            return
+        painter.setPen(QPen(self.color, self.pen_width()))
+        self.draw_batch(painter, [self.batch_item(*self.get_bounding_rect())])
+        if self.is_selected:
+            self.draw_outlines(painter, *self.outline())
+
+    # Отрисовка пачками (DrawBatches): фигуры одного класса и пера рисуются одним
+    # draw_batch, рамки выделения - одним draw_outlines в конце кадра.
+    def pen_width(self) -> int:
+        return 2
+
+    @staticmethod
+    @abstractmethod
+    def batch_item(x, y, w, h):
+        """Геометрия фигуры для draw_batch."""
+
+    @staticmethod
+    @abstractmethod
+    def draw_batch(painter: QPainter, items: list): pass
+
+    def outline(self) -> tuple:
+        """(цвет, толщина, стиль пера, эллипс ли, рамка) пунктира выделения."""
+        x, y, w, h = self.get_bounding_rect()
+        return (self.selection_color, 2, Qt.PenStyle.DashLine, False,
+                QRect(int(x - 3), int(y - 3), int(w + 6), int(h + 6)))
 
     def get_children(self) -> List[Component]:
         return []
@@ -138,82 +515,106 @@ class Shape(Component):
         return type(self).__name__.lower()
 
     def save(self) -> Dict[str, Any]:
+        return self._record(self.freeze())
+
+    def freeze(self) -> tuple:
+        st, r = self.store, self._row
+        return (type(self), self.id, self._is_selected, st.xs[r], st.ys[r], st.ws[r], st.hs[r], st.colors[r])
+
+    @classmethod
+    def _record(cls, frozen: tuple) -> Dict[str, Any]:
+        _, cid, selected, x, y, w, h, rgba = frozen
         return {
-            'id': self.id,
-            'type': self.get_type_name(),
-            'x': self._x,
-            'y': self._y,
-            'width': self._width,
-            'height': self._height,
-            'color': self._color.name(),
-            'is_selected': self.is_selected
+            'id': cid,
+            'type': cls.__name__.lower(),
+            'x': x,
+            'y': y,
+            'width': w,
+            'height': h,
+            'color': QColor.fromRgba(rgba).name(),
+            'is_selected': selected
         }
 
     def load(self, data: Dict[str, Any]):
-        self._id = data.get('id', self._id)
-        self._x = data['x']
-        self._y = data['y']
-        self._width = data['width']
-        self._height = data['height']
-        self._color = QColor(data['color'])
+        st, r = self.store, self._row
+        self._load_id(data)
+        st.xs[r] = data['x']
+        st.ys[r] = data['y']
+        st.ws[r] = data['width']
+        st.hs[r] = data['height']
+        st.arrays = None
+        color = data['color']
+        st.colors[r] = color if isinstance(color, int) else QColor(color).rgba()
         self.is_selected = data['is_selected']
 
 
 class Circle(Shape):
-    def draw(self, painter):
-        painter.setPen(QPen(self._color, 2))
-        painter.drawEllipse(int(self.x), int(self.y), int(self.width), int(self.height))
-        if self.is_selected:
-            painter.setPen(QPen(self.selection_color, 2, Qt.PenStyle.DashLine))
-            painter.drawEllipse(int(self.x - 3), int(self.y - 3), int(self.width + 6), int(self.height + 6))
+    __slots__ = ()
+    KIND = 0
+
+    @staticmethod
+    def batch_item(x, y, w, h):
+        return QRect(int(x), int(y), int(w), int(h))
+
+    @staticmethod
+    def draw_batch(painter, items):
+        for rect in items:
+            painter.drawEllipse(rect)
+
+    def outline(self):
+        color, width, style, _, rect = super().outline()
+        return color, width, style, True, rect
 
     def contains(self, point):
-        cx = self.x + self.width / 2
-        cy = self.y + self.height / 2
-        r = min(self.width, self.height) / 2
+        x, y, w, h = self.get_bounding_rect()
+        cx = x + w / 2
+        cy = y + h / 2
+        r = min(w, h) / 2
         return math.hypot(point.x() - cx, point.y() - cy) <= r
 
 
 class Rectangle(Shape):
-    def __init__(self, x, y):
-        super().__init__(x, y)
-        self._width = 80
-        self._height = 50
+    __slots__ = ()
+    KIND = 1
+    DEFAULT_SIZE = (80, 50)
 
-    def draw(self, painter):
-        painter.setPen(QPen(self._color, 2))
-        painter.drawRect(int(self.x), int(self.y), int(self.width), int(self.height))
-        if self.is_selected:
-            painter.setPen(QPen(self.selection_color, 2, Qt.PenStyle.DashLine))
-            painter.drawRect(int(self.x - 3), int(self.y - 3), int(self.width + 6), int(self.height + 6))
+    @staticmethod
+    def batch_item(x, y, w, h):
+        return QRect(int(x), int(y), int(w), int(h))
+
+    @staticmethod
+    def draw_batch(painter, items):
+        painter.drawRects(items)
 
     def contains(self, point):
-        return self.x <= point.x() <= self.x + self.width and self.y <= point.y() <= self.y + self.height
+        x, y, w, h = self.get_bounding_rect()
+        return x <= point.x() <= x + w and y <= point.y() <= y + h
 
 
 class Triangle(Shape):
-    def __init__(self, x, y):
-        super().__init__(x, y)
-        self._width = 70
-        self._height = 70
+    __slots__ = ()
+    KIND = 2
+    DEFAULT_SIZE = (70, 70)
 
-    def draw(self, painter):
-        points = [
-            QPointF(self.x + self.width / 2, self.y),
-            QPointF(self.x, self.y + self.height),
-            QPointF(self.x + self.width, self.y + self.height)
-        ]
-        painter.setPen(QPen(self._color, 2))
-        painter.drawPolygon(points)
-        if self.is_selected:
-            painter.setPen(QPen(self.selection_color, 2, Qt.PenStyle.DashLine))
-            painter.drawRect(int(self.x - 3), int(self.y - 3), int(self.width + 6), int(self.height + 6))
+    @staticmethod
+    def batch_item(x, y, w, h):
+        return QPolygonF([
+            QPointF(x + w / 2, y),
+            QPointF(x, y + h),
+            QPointF(x + w, y + h)
+        ])
+
+    @staticmethod
+    def draw_batch(painter, items):
+        for polygon in items:
+            painter.drawPolygon(polygon)
 
     def contains(self, point):
         x, y = point.x(), point.y()
-        x1, y1 = self.x + self.width / 2, self.y
-        x2, y2 = self.x, self.y + self.height
-        x3, y3 = self.x + self.width, self.y + self.height
+        bx, by, bw, bh = self.get_bounding_rect()
+        x1, y1 = bx + bw / 2, by
+        x2, y2 = bx, by + bh
+        x3, y3 = bx + bw, by + bh
 
         def sign(p1x, p1y, p2x, p2y, p3x, p3y):
             return (p1x - p3x) * (p2y - p3y) - (p2x - p3x) * (p1y - p3y)
@@ -227,22 +628,35 @@ class Triangle(Shape):
 
 
 class Line(Shape):
-    def __init__(self, x, y):
-        super().__init__(x, y)
-        self._width = 100
-        self._height = 5
+    __slots__ = ()
+    KIND = 3
+    DEFAULT_SIZE = (100, 5)
+    outline_color = QColor(0, 255, 0)
 
-    def draw(self, painter):
-        painter.setPen(QPen(self._color, int(self.height)))
-        painter.drawLine(int(self.x), int(self.y), int(self.x + self.width), int(self.y))
-        if self.is_selected:
-            painter.setPen(QPen(QColor(0, 255, 0), 3, Qt.PenStyle.DashLine))
-            painter.drawRect(int(self.x - 5), int(self.y - 10), int(self.width + 10), 20)
+    def pen_width(self):
+        return int(self.store.hs[self._row])
+
+    @staticmethod
+    def batch_item(x, y, w, h):
+        return QLine(int(x), int(y), int(x + w), int(y))
+
+    @staticmethod
+    def draw_batch(painter, items):
+        painter.drawLines(items)
+
+    def outline(self):
+        x, y, w, h = self.get_bounding_rect()
+        return (self.outline_color, 3, Qt.PenStyle.DashLine, False,
+                QRect(int(x - 5), int(y - 10), int(w + 10), 20))
+
+    def get_paint_rect(self):
+        x, y, w, h = self.get_bounding_rect()
+        m = max(12, h / 2 + 2)
+        return (x - 8, y - m, w + 16, 2 * m)
 
     def contains(self, point):
-        x1 = self.x
-        x2 = self.x + self.width
-        y1 = self.y
+        x1, y1, w, _ = self.get_bounding_rect()
+        x2 = x1 + w
         if min(x1, x2) - 10 <= point.x() <= max(x1, x2) + 10 and abs(point.y() - y1) <= 15:
             return True
         return False
@@ -267,25 +681,32 @@ class Arrow(Component):
     @property
     def height(self): return self.get_bounding_rect()[3]
 
+    # наконечник рисуется от центра цели на столько пикселей
+    HEAD_SIZE = 15
+
+    def endpoints(self) -> Tuple[float, float, float, float]:
+        """Центры источника и цели: стрелка идёт между ними."""
+        src = self.source.get_bounding_rect()
+        tgt = self.target.get_bounding_rect()
+        return (src[0] + src[2] / 2, src[1] + src[3] / 2,
+                tgt[0] + tgt[2] / 2, tgt[1] + tgt[3] / 2)
+
     def draw(self, painter: QPainter):
         if not self.source or not self.target: return
         painter.save()
         try:
-            src = self.source.get_bounding_rect()
-            tgt = self.target.get_bounding_rect()
-            src_x = src[0] + src[2] / 2
-            src_y = src[1] + src[3] / 2
-            tgt_x = tgt[0] + tgt[2] / 2
-            tgt_y = tgt[1] + tgt[3] / 2
+            src_x, src_y, tgt_x, tgt_y = self.endpoints()
             pen = QPen(self.color, 3)
             painter.setPen(pen)
             painter.drawLine(QPointF(src_x, src_y), QPointF(tgt_x, tgt_y))
-            angle = math.atan2(tgt_y - src_y, tgt_x - src_x)
-            arrow_size = 15
-            p2 = QPointF(tgt_x - arrow_size * math.cos(angle - math.pi / 6), tgt_y - arrow_size * math.sin(angle - math.pi / 6))
-            p3 = QPointF(tgt_x - arrow_size * math.cos(angle + math.pi / 6), tgt_y - arrow_size * math.sin(angle + math.pi / 6))
-            painter.setBrush(QBrush(self.color))
-            painter.drawPolygon([QPointF(tgt_x, tgt_y), p2, p3])
+            lod = self.detail
+            if math.hypot(tgt_x - src_x, tgt_y - src_y) * lod.scale >= lod.arrow_cutoff:
+                angle = math.atan2(tgt_y - src_y, tgt_x - src_x)
+                arrow_size = self.HEAD_SIZE
+                p2 = QPointF(tgt_x - arrow_size * math.cos(angle - math.pi / 6), tgt_y - arrow_size * math.sin(angle - math.pi / 6))
+                p3 = QPointF(tgt_x - arrow_size * math.cos(angle + math.pi / 6), tgt_y - arrow_size * math.sin(angle + math.pi / 6))
+                painter.setBrush(QBrush(self.color))
+                painter.drawPolygon([QPointF(tgt_x, tgt_y), p2, p3])
             if self.is_selected:
                 painter.setPen(QPen(self.selection_color, 2, Qt.PenStyle.DashLine))
                 painter.drawLine(QPointF(src_x, src_y), QPointF(tgt_x, tgt_y))
@@ -294,12 +715,7 @@ class Arrow(Component):
 
     def contains(self, point) -> bool:
         if not self.source or not self.target: return False
-        src = self.source.get_bounding_rect()
-        tgt = self.target.get_bounding_rect()
-        src_x = src[0] + src[2] / 2
-        src_y = src[1] + src[3] / 2
-        tgt_x = tgt[0] + tgt[2] / 2
-        tgt_y = tgt[1] + tgt[3] / 2
+        src_x, src_y, tgt_x, tgt_y = self.endpoints()
         px, py = point.x(), point.y()
         line_len = math.sqrt((tgt_x - src_x)**2 + (tgt_y - src_y)**2)
         if line_len == 0: return False
@@ -327,112 +743,225 @@ class Arrow(Component):
     def set_color(self, color: QColor): self.color = color
 
     def save(self):
+        return self._record(self.freeze())
+
+    def freeze(self):
+        return (Arrow, self.id, self._is_selected, self.color.rgba(), self.source.id, self.target.id)
+
+    @classmethod
+    def _record(cls, frozen):
+        _, cid, selected, rgba, source_id, target_id = frozen
         return {
             'type': 'arrow',
-            'id': self.id,
-            'is_selected': self.is_selected,
-            'color': self.color.name(),
-            'source_id': self.source.id,
-            'target_id': self.target.id
+            'id': cid,
+            'is_selected': selected,
+            'color': QColor.fromRgba(rgba).name(),
+            'source_id': source_id,
+            'target_id': target_id
         }
 
     def load(self, data):
-        self._id = data.get('id', self._id)
+        self._load_id(data)
         self.is_selected = data['is_selected']
-        self.color = QColor(data['color'])
+        color = data['color']
+        self.color = QColor.fromRgba(color) if isinstance(color, int) else QColor(color)
         self._saved_source_id = data['source_id']
         self._saved_target_id = data['target_id']
 
 
 class Group(Component):
+    """Рамка группы кэшируется и пересчитывается лениво.
+
+    Изменение потомка помечает устаревшими рамки всех групп на пути к корню
+    (O(глубины)). Сдвиг группы - один проход ShapeStore.translate по строкам
+    всех её листьев и сдвиг кэшированных рамок вложенных групп, без вызова
+    move() у каждого листа. Поэтому все листья группы держат строки в одном
+    хранилище: add() переносит в него строки нового потомка.
+    """
+
     def __init__(self):
         super().__init__()
         self._children: List[Component] = []
         self._x = self._y = self._width = self._height = 0
+        self._dirty = False
+        # строки листьев и вложенные группы, None - состав изменился
+        self._layout = None
         self.selection_color = QColor(255, 255, 0)
 
     @property
-    def x(self): return self._x
+    def x(self): return self.get_bounding_rect()[0]
     @property
-    def y(self): return self._y
+    def y(self): return self.get_bounding_rect()[1]
     @property
-    def width(self): return self._width
+    def width(self): return self.get_bounding_rect()[2]
     @property
-    def height(self): return self._height
+    def height(self): return self.get_bounding_rect()[3]
+
+    def _invalidate(self):
+        group = self
+        # у устаревшей группы устарели и все предки
+        while group is not None and not group._dirty:
+            group._dirty = True
+            group = group._parent
 
     def _update_bounds(self):
+        self._dirty = False
         if not self._children:
             self._x = self._y = self._width = self._height = 0
             return
-        min_x = min(c.x for c in self._children)
-        min_y = min(c.y for c in self._children)
-        max_x = max(c.x + c.width for c in self._children)
-        max_y = max(c.y + c.height for c in self._children)
+        rects = [c.get_bounding_rect() for c in self._children]
+        min_x = min(r[0] for r in rects)
+        min_y = min(r[1] for r in rects)
+        max_x = max(r[0] + r[2] for r in rects)
+        max_y = max(r[1] + r[3] for r in rects)
         self._x = min_x
         self._y = min_y
         self._width = max_x - min_x
         self._height = max_y - min_y
 
+    def _leaf_layout(self):
+        """(строки ShapeStore всех листьев, все вложенные группы)."""
+        if self._layout is None:
+            rows, groups = [], []
+            for child in self._children:
+                if isinstance(child, Group):
+                    child_rows, child_groups = child._leaf_layout()
+                    rows.extend(child_rows)
+                    groups.append(child)
+                    groups.extend(child_groups)
+                else:
+                    rows.append(child._row)
+            self._layout = (rows, groups)
+        return self._layout
+
+    def _leaf_store(self) -> Optional[ShapeStore]:
+        """Хранилище строк листьев; None - в группе нет ни одного листа."""
+        for child in self._children:
+            store = child._leaf_store() if isinstance(child, Group) else child.store
+            if store is not None:
+                return store
+        return None
+
+    def _leaves(self, out: List[Shape], groups: List['Group']):
+        groups.append(self)
+        for child in self._children:
+            if isinstance(child, Group):
+                child._leaves(out, groups)
+            else:
+                out.append(child)
+
+    def _rehome(self, store: ShapeStore):
+        leaves, groups = [], []
+        self._leaves(leaves, groups)
+        if ShapeStore.move_to(leaves, store):
+            # номера строк сменились - кэш _leaf_layout устарел
+            for group in groups:
+                group._layout = None
+
     def add(self, component: Component):
+        store = self._leaf_store()
+        if store is not None:
+            component._rehome(store)
         self._children.append(component)
-        self._update_bounds()
+        component._parent = self
+        group = self
+        while group is not None:
+            group._layout = None
+            group = group._parent
+        self._invalidate()
 
     def draw(self, painter):
         for child in self._children:
             child.draw(painter)
         if self.is_selected:
-            painter.setPen(QPen(self.selection_color, 2, Qt.PenStyle.DashDotLine))
-            painter.drawRect(int(self._x - 5), int(self._y - 5), int(self._width + 10), int(self._height + 10))
+            self.draw_outlines(painter, *self.outline())
+
+    def outline(self) -> tuple:
+        x, y, w, h = self.get_bounding_rect()
+        return (self.selection_color, 2, Qt.PenStyle.DashDotLine, False,
+                QRect(int(x - 5), int(y - 5), int(w + 10), int(h + 10)))
 
     def contains(self, point):
-        if not (self._x <= point.x() <= self._x + self._width and self._y <= point.y() <= self._y + self._height):
+        x, y, w, h = self.get_bounding_rect()
+        if not (x <= point.x() <= x + w and y <= point.y() <= y + h):
             return False
         return any(child.contains(point) for child in self._children)
 
     def move(self, dx, dy, fw, fh):
-        new_x = self._x + dx
-        new_y = self._y + dy
-        if not (0 <= new_x and new_x + self._width <= fw and 0 <= new_y and new_y + self._height <= fh):
+        x, y, w, h = self.get_bounding_rect()
+        new_x = x + dx
+        new_y = y + dy
+        if not (0 <= new_x and new_x + w <= fw and 0 <= new_y and new_y + h <= fh):
             return False
-        for child in self._children:
-            child.move(dx, dy, fw, fh)
-        self._update_bounds()
+        rows = self._leaf_layout()[0]
+        if rows:
+            self._leaf_store().translate(rows, dx, dy)
+        self._shifted(dx, dy)
+        self._changed()
         return True
 
+    def _shifted(self, dx, dy):
+        """Листья уже сдвинуты: вложенные рамки сдвигаются вместе с ними и остаются верными."""
+        for group in [self] + self._leaf_layout()[1]:
+            group._x += dx
+            group._y += dy
+
+    def _adopt(self, children: List[Component]):
+        """Снова собирает группу из детей (повтор группировки, отмена разгруппировки)."""
+        self._children = []
+        self._layout = None
+        for child in children:
+            child.is_selected = False
+            self.add(child)
+
+    def _release(self):
+        """Дети выходят на верхний уровень; список детей остаётся для отмены."""
+        for child in self._children:
+            child._parent = None
+
+    def _forget_bounds(self):
+        """Листья изменены в обход move(): рамки группы и всех вложенных групп устарели."""
+        for group in self._leaf_layout()[1]:
+            group._dirty = True
+        self._invalidate()
+
     def resize_shape(self, dw, dh, fw, fh):
         if not self._children: return False
-        scale_x = 1 + dw / max(self._width, 1)
-        scale_y = 1 + dh / max(self._height, 1)
-        for child in self._children:
-            rel_x = child.x - self._x
-            rel_y = child.y - self._y
-            new_w = child.width * scale_x
-            new_h = child.height * scale_y
-            new_x = self._x + rel_x * scale_x
-            new_y = self._y + rel_y * scale_y
-            if new_x < 0 or new_y < 0 or new_x + new_w > fw or new_y + new_h > fh:
-                return False
-        for child in self._children:
-            rel_x = child.x - self._x
-            rel_y = child.y - self._y
-            child.width = child.width * scale_x
-            child.height = child.height * scale_y
-            child.x = self._x + rel_x * scale_x
-            child.y = self._y + rel_y * scale_y
-        self._update_bounds()
+        gx, gy, gw, gh = self.get_bounding_rect()
+        scale_x = 1 + dw / max(gw, 1)
+        scale_y = 1 + dh / max(gh, 1)
+        # листья масштабируются от угла группы, поэтому хватает проверки новой рамки группы
+        if scale_x <= 0 or scale_y <= 0 or gx + gw * scale_x > fw or gy + gh * scale_y > fh:
+            return False
+        self._leaf_store().scale(self._leaf_layout()[0], gx, gy, scale_x, scale_y)
+        self._forget_bounds()
         return True
 
     def adjust_to_bounds(self, fw, fh):
         for child in self._children:
             child.adjust_to_bounds(fw, fh)
-        self._update_bounds()
+        self._invalidate()
 
     def get_bounding_rect(self):
+        if self._dirty:
+            self._update_bounds()
         return (self._x, self._y, self._width, self._height)
 
+    def settle(self):
+        super().settle()
+        self.get_bounding_rect()
+        for child in self._children:
+            child.settle()
+
     def get_children(self):
         return self._children.copy()
 
+    def child_count(self):
+        return len(self._children)
+
+    def children_slice(self, start, stop):
+        return self._children[start:stop]
+
     def get_type_name(self):
         return 'group'
 
@@ -441,239 +970,2339 @@ class Group(Component):
             child.set_color(color)
 
     def save(self):
+        return self._record(self.freeze())
+
+    def freeze(self):
+        return (Group, self.id, self._is_selected, self.get_bounding_rect(), [c.freeze() for c in self._children])
+
+    @classmethod
+    def _record(cls, frozen):
+        _, cid, selected, (x, y, w, h), children = frozen
         return {
-            'id': self.id,
+            'id': cid,
             'type': 'group',
-            'x': self._x,
-            'y': self._y,
-            'width': self._width,
-            'height': self._height,
-            'is_selected': self.is_selected,
-            'children': [c.save() for c in self._children]
+            'x': x,
+            'y': y,
+            'width': w,
+            'height': h,
+            'is_selected': selected,
+            'children': [Component.thaw(child) for child in children]
         }
 
     def load(self, data):
-        self._id = data.get('id', self._id)
+        self._load_id(data)
         self._x = data['x']
         self._y = data['y']
         self._width = data['width']
         self._height = data['height']
         self.is_selected = data['is_selected']
         self._children = []
+        self._layout = None
         for child_data in data['children']:
-            child = ShapeFactory.create_shape(child_data['type'])
+            child = ShapeFactory.create_shape(child_data['type'], store=self._leaf_store())
             child.load(child_data)
-            self._children.append(child)
-        self._update_bounds()
+            self.add(child)
+        self._invalidate()
+
+
+class DrawBatches:
+    """Кадр, собранный в пачки по стилю: одно перо и один групповой вызов на пачку.
+
+    Создаётся после LevelOfDetail.begin кадра. Ключ пачки - (draw_batch, цвет,
+    толщина пера). Фигура попадает в последнюю пачку своего ключа, если ни одна
+    более поздняя пачка не рисует в тех же ячейках CELL x CELL (как ShapeBatches
+    в oop_lab44), иначе открывается новая пачка - перекрывающиеся фигуры ложатся
+    в прежнем z-порядке. Мелкие по LevelOfDetail фигуры собираются в пачки точек
+    и прямоугольников, стрелки рисуются своим draw() в пачках DIRECT, группы
+    раскладываются на потомков. Рамки выделения рисуются последним проходом
+    поверх кадра.
+    """
+    CELL = 64
+    ROW = 1 << 20
+    DIRECT = None
+    # перья по (цвет, толщина) общие для всех кадров; разных стилей в документе немного
+    _pens: Dict[Tuple[int, int], QPen] = {}
+    MAX_PENS = 1024
+
+    def __init__(self):
+        self._batches: List[Tuple[Any, list]] = []
+        # ключ -> номер последней пачки с этим ключом
+        self._open: Dict[Any, int] = {}
+        # ячейка -> номер последней пачки, рисующей в ней, плюс один
+        self._top: Dict[int, int] = {}
+        # сглаживание задевает соседние пиксели кадра; при уменьшении это больше PAINT_MARGIN
+        self._pad = 2 / Component.detail.scale
+        self._outlines: Dict[tuple, List[QRect]] = defaultdict(list)
+
+    def __len__(self):
+        return len(self._batches)
+
+    def add_all(self, components):
+        for component in components:
+            self.add(component)
+
+    def add(self, component: Component):
+        kind = type(component)
+        if kind in self._SHAPES:
+            st, r = component.store, component._row
+            x, y, w, h = st.xs[r], st.ys[r], st.ws[r], st.hs[r]
+            coarse = Component.detail.coarse_item(x, y, w, h)
+            if coarse is None:
+                key, item = (kind.draw_batch, st.colors[r], component.pen_width()), kind.batch_item(x, y, w, h)
+                if component._is_selected:
+                    self._outline(component)
+            else:
+                color = component.selection_color.rgba() if component._is_selected else st.colors[r]
+                key, item = (coarse[0], color, 0), coarse[1]
+            if kind is Line:
+                self._place(key, item, *component.get_paint_rect())
+            else:
+                m = Shape.PAINT_MARGIN
+                self._place(key, item, x - m, y - m, w + 2 * m, h + 2 * m)
+        elif isinstance(component, Group):
+            for child in component.get_children():
+                self.add(child)
+            if component.is_selected:
+                self._outline(component)
+        else:
+            self._place(self.DIRECT, component, *component.get_paint_rect())
+
+    def _outline(self, component: Component):
+        color, width, style, ellipse, rect = component.outline()
+        self._outlines[color.rgba(), width, style, ellipse].append(rect)
+
+    def _place(self, key, item, x, y, w, h):
+        c, pad = self.CELL, self._pad
+        # ячейка - число row * ROW + col
+        col0, col1 = int((x - pad) // c), int((x + w + pad) // c) + 1
+        row0, row1 = int((y - pad) // c), int((y + h + pad) // c) + 1
+        rows = range(self.ROW * row0, self.ROW * row1, self.ROW)
+        top = self._top
+        get = top.get
+        last = 0
+        for row in rows:
+            for cell in range(row + col0, row + col1):
+                t = get(cell, 0)
+                if t > last:
+                    last = t
+        index = self._open.get(key)
+        if index is None or index < last - 1:
+            index = self._open[key] = len(self._batches)
+            self._batches.append((key, []))
+        self._batches[index][1].append(item)
+        index += 1
+        for row in rows:
+            for cell in range(row + col0, row + col1):
+                top[cell] = index
+
+    def draw(self, painter: QPainter):
+        painter.setBrush(Qt.BrushStyle.NoBrush)
+        pens = self._pens
+        if len(pens) > self.MAX_PENS:
+            pens.clear()
+        for key, items in self._batches:
+            if key is self.DIRECT:
+                for component in items:
+                    component.draw(painter)
+                continue
+            draw_batch, rgba, width = key
+            pen = pens.get((rgba, width))
+            if pen is None:
+                pen = pens[rgba, width] = QPen(QColor.fromRgba(rgba), width)
+            painter.setPen(pen)
+            draw_batch(painter, items)
+        for (rgba, width, style, ellipse), rects in self._outlines.items():
+            Component.draw_outlines(painter, QColor.fromRgba(rgba), width, style, ellipse, *rects)
+
+
+DrawBatches._SHAPES = frozenset((Circle, Rectangle, Triangle, Line))
 
 
 class ShapeFactory:
     @staticmethod
-    def create_shape(shape_type: str, x: float = 0, y: float = 0) -> Component:
+    def create_shape(shape_type: str, x: float = 0, y: float = 0,
+                     store: Optional[ShapeStore] = None) -> Component:
+        """store - хранилище строк фигуры, None - собственное."""
         if shape_type == 'circle':
-            return Circle(x, y)
+            return Circle(x, y, store)
         elif shape_type == 'rectangle':
-            return Rectangle(x, y)
+            return Rectangle(x, y, store)
         elif shape_type == 'triangle':
-            return Triangle(x, y)
+            return Triangle(x, y, store)
         elif shape_type == 'line':
-            return Line(x, y)
+            return Line(x, y, store)
         elif shape_type == 'group':
             return Group()
         else:
             raise ValueError(f"Неизвестный тип: {shape_type}")
 
 
+class BinaryDocument:
+    """Компактный двоичный формат документа, пишется и читается потоково.
+
+    После заголовка идут записи с однобайтовым тегом. Строки (id) попадают в
+    таблицу строк отдельной записью перед первым использованием, остальные
+    записи ссылаются на них по номеру. Группа - заголовок с числом детей, за
+    которым следуют записи самих детей.
+
+    За записью конца лежит индекс для произвольного доступа (см. MappedDocument):
+    смещение, тег, флаги и область отрисовки каждой записи верхнего уровня,
+    смещения строк и таблица "id концов стрелок -> запись верхнего уровня".
+    Потоковое чтение индекс не трогает.
+    """
+    MAGIC = b'FIGB'
+    INDEX_MAGIC = b'FIDX'
+    VERSION = 1
+
+    TAG_STRING = 1
+    TAG_SHAPE = 2
+    TAG_GROUP = 3
+    TAG_ARROW = 4
+    TAG_END = 0xFF
+
+    # индекс - Shape.KIND
+    SHAPE_TYPES = ['circle', 'rectangle', 'triangle', 'line']
+
+    _header = struct.Struct('<4sH')
+    _tag = struct.Struct('<B')
+    _string_len = struct.Struct('<H')
+    # тип, флаги, id, x, y, ширина, высота, цвет (ARGB)
+    _shape = struct.Struct('<BBIddddI')
+    # флаги, id, x, y, ширина, высота, число детей
+    _group = struct.Struct('<BIddddI')
+    # флаги, id, источник, цель, цвет
+    _arrow = struct.Struct('<BIIII')
+    _count = struct.Struct('<I')
+    # смещение, тег, флаги, область отрисовки
+    _entry = struct.Struct('<QBBdddd')
+    _offset = struct.Struct('<Q')
+    # номер строки id, номер записи верхнего уровня
+    _anchor = struct.Struct('<II')
+    # смещения записей, строк и якорей
+    _trailer = struct.Struct('<QQQ4s')
+
+    FLAG_SELECTED = 1
+
+    @classmethod
+    def is_binary(cls, filename: str) -> bool:
+        with open(filename, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def write(cls, f, components: List[Component], progress=None, index: bool = True):
+        """progress(записано, всего) зовётся через каждые 1024 записи верхнего уровня.
+
+        index=False - только поток записей, без индекса для MappedDocument.
+        """
+        strings: Dict[str, int] = {}
+        string_offsets: List[int] = []
+        entries: List[bytes] = []
+        endpoints = set()
+        for c in components:
+            if isinstance(c, Arrow):
+                endpoints.add(c.source)
+                endpoints.add(c.target)
+        anchors: List[Tuple[int, int]] = []
+        pos = 0
+
+        def emit(chunk: bytes):
+            nonlocal pos
+            f.write(chunk)
+            pos += len(chunk)
+
+        def ref(value: str) -> int:
+            idx = strings.get(value)
+            if idx is None:
+                idx = strings[value] = len(strings)
+                raw = value.encode('utf-8')
+                emit(cls._tag.pack(cls.TAG_STRING))
+                string_offsets.append(pos)
+                emit(cls._string_len.pack(len(raw)) + raw)
+            return idx
+
+        def write_component(c: Component, record: int):
+            flags = cls.FLAG_SELECTED if c.is_selected else 0
+            if isinstance(c, Arrow):
+                src, tgt = ref(c.source.id), ref(c.target.id)
+                emit(cls._tag.pack(cls.TAG_ARROW)
+                     + cls._arrow.pack(flags, ref(c.id), src, tgt, c.color.rgba()))
+                return
+            sid = ref(c.id)
+            if c in endpoints:
+                anchors.append((sid, record))
+            if isinstance(c, Group):
+                children = c.get_children()
+                emit(cls._tag.pack(cls.TAG_GROUP)
+                     + cls._group.pack(flags, sid, c.x, c.y, c.width, c.height, len(children)))
+                for child in children:
+                    write_component(child, record)
+            else:
+                emit(cls._tag.pack(cls.TAG_SHAPE)
+                     + cls._shape.pack(c.KIND, flags, sid,
+                                       *c.get_bounding_rect(), c.store.colors[c._row]))
+
+        emit(cls._header.pack(cls.MAGIC, cls.VERSION))
+        for record, component in enumerate(components):
+            if progress and record % 1024 == 0:
+                progress(record, len(components))
+            # строки, впервые встреченные в записи, пишутся перед ней и в запись не входят
+            if isinstance(component, Arrow):
+                ref(component.source.id)
+                ref(component.target.id)
+            ref(component.id)
+            start = pos
+            write_component(component, record)
+            tag = cls.TAG_ARROW if isinstance(component, Arrow) else \
+                cls.TAG_GROUP if isinstance(component, Group) else cls.TAG_SHAPE
+            entries.append(cls._entry.pack(start, tag, 1 if component.is_selected else 0,
+                                           *component.get_paint_rect()))
+        emit(cls._tag.pack(cls.TAG_END))
+        if not index:
+            return
+
+        entries_at = pos
+        emit(cls._count.pack(len(entries)))
+        for entry in entries:
+            emit(entry)
+        strings_at = pos
+        emit(cls._count.pack(len(string_offsets)))
+        for offset in string_offsets:
+            emit(cls._offset.pack(offset))
+        anchors_at = pos
+        emit(cls._count.pack(len(anchors)))
+        for anchor in anchors:
+            emit(cls._anchor.pack(*anchor))
+        emit(cls._trailer.pack(entries_at, strings_at, anchors_at, cls.INDEX_MAGIC))
+
+    @classmethod
+    def _read_record(cls, read_exact, strings, color=QColor.fromRgba):
+        """Одна запись (с вложенными) в виде словаря формата save(); None - конец.
+
+        strings - таблица строк: встреченные по пути строки добавляются через append,
+        ссылки разрешаются через []. color превращает ARGB записи в значение 'color'.
+        """
+        while True:
+            tag = read_exact(1)[0]
+            if tag != cls.TAG_STRING:
+                break
+            size, = cls._string_len.unpack(read_exact(cls._string_len.size))
+            strings.append(read_exact(size).decode('utf-8'))
+        if tag == cls.TAG_SHAPE:
+            code, flags, sid, x, y, w, h, argb = cls._shape.unpack(read_exact(cls._shape.size))
+            return {'type': cls.SHAPE_TYPES[code], 'id': strings[sid], 'x': x, 'y': y,
+                    'width': w, 'height': h, 'color': color(argb),
+                    'is_selected': bool(flags & cls.FLAG_SELECTED)}
+        if tag == cls.TAG_GROUP:
+            flags, sid, x, y, w, h, count = cls._group.unpack(read_exact(cls._group.size))
+            return {'type': 'group', 'id': strings[sid], 'x': x, 'y': y, 'width': w, 'height': h,
+                    'is_selected': bool(flags & cls.FLAG_SELECTED),
+                    'children': [cls._read_record(read_exact, strings, color) for _ in range(count)]}
+        if tag == cls.TAG_ARROW:
+            flags, sid, src, tgt, argb = cls._arrow.unpack(read_exact(cls._arrow.size))
+            return {'type': 'arrow', 'id': strings[sid], 'color': color(argb),
+                    'is_selected': bool(flags & cls.FLAG_SELECTED),
+                    'source_id': strings[src], 'target_id': strings[tgt]}
+        if tag == cls.TAG_END:
+            return None
+        raise ValueError(f"Неизвестная запись: {tag}")
+
+    @classmethod
+    def read(cls, f, color=QColor.fromRgba):
+        """Отдаёт записи верхнего уровня по одной в виде словарей формата save().
+
+        color=int оставляет цвета числами ARGB (Shape.load и Arrow.load их принимают).
+        """
+        magic, version = cls._header.unpack(f.read(cls._header.size))
+        if magic != cls.MAGIC:
+            raise ValueError("Не двоичный документ")
+        if version > cls.VERSION:
+            raise ValueError(f"Неподдерживаемая версия: {version}")
+        strings: List[str] = []
+
+        def read_exact(n):
+            data = f.read(n)
+            if len(data) != n:
+                raise ValueError("Файл обрезан")
+            return data
+
+        while True:
+            record = cls._read_record(read_exact, strings, color)
+            if record is None:
+                return
+            yield record
+
+
+class MappedDocument:
+    """Двоичный документ с индексом, отображённый в память; записи декодируются по запросу.
+
+    Держит файл открытым до close(); пока отображение живо, файл нельзя
+    подменить (os.replace на Windows), поэтому контейнер закрывает документ,
+    когда его сменяет другой или перед сохранением поверх него.
+    """
+
+    class _Strings:
+        def __init__(self, document: 'MappedDocument'):
+            self._document = document
+            self._cache: Dict[int, str] = {}
+
+        def append(self, value: str):
+            pass
+
+        def __getitem__(self, idx: int) -> str:
+            value = self._cache.get(idx)
+            if value is None:
+                value = self._cache[idx] = self._document._string_at(idx)
+            return value
+
+    def __init__(self, filename: str):
+        self._file = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        try:
+            self._read_header()
+        except Exception:
+            self.close()
+            raise
+        self.strings = MappedDocument._Strings(self)
+
+    def _read_header(self):
+        bd = BinaryDocument
+        magic, version = bd._header.unpack_from(self._map, 0)
+        if magic != bd.MAGIC or version > bd.VERSION or len(self._map) < bd._header.size + bd._trailer.size:
+            raise ValueError("Не двоичный документ")
+        entries_at, strings_at, anchors_at, index_magic = bd._trailer.unpack_from(
+            self._map, len(self._map) - bd._trailer.size)
+        if index_magic != bd.INDEX_MAGIC:
+            raise ValueError("В документе нет индекса")
+        self.count, = bd._count.unpack_from(self._map, entries_at)
+        self._entries_at = entries_at + bd._count.size
+        self._strings_at = strings_at + bd._count.size
+        self._anchors_at = anchors_at
+
+    def close(self):
+        """Отпускает отображение и файл; повторный вызов ничего не делает."""
+        if not self._map.closed:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def is_indexed(filename: str) -> bool:
+        bd = BinaryDocument
+        with open(filename, 'rb') as f:
+            if f.read(len(bd.MAGIC)) != bd.MAGIC:
+                return False
+            f.seek(0, 2)
+            if f.tell() < bd._header.size + bd._trailer.size:
+                return False
+            f.seek(-bd._trailer.size, 2)
+            return bd._trailer.unpack(f.read(bd._trailer.size))[3] == bd.INDEX_MAGIC
+
+    def _string_at(self, idx: int) -> str:
+        bd = BinaryDocument
+        offset, = bd._offset.unpack_from(self._map, self._strings_at + idx * bd._offset.size)
+        size, = bd._string_len.unpack_from(self._map, offset)
+        start = offset + bd._string_len.size
+        return self._map[start:start + size].decode('utf-8')
+
+    def entry(self, record: int) -> tuple:
+        """(смещение, тег, флаги, x, y, ширина, высота) записи верхнего уровня."""
+        return BinaryDocument._entry.unpack_from(self._map, self._entries_at + record * BinaryDocument._entry.size)
+
+    def anchors(self) -> Dict[str, int]:
+        """id концов стрелок -> номер записи верхнего уровня, которая их содержит."""
+        bd = BinaryDocument
+        count, = bd._count.unpack_from(self._map, self._anchors_at)
+        start = self._anchors_at + bd._count.size
+        return {self.strings[sid]: record
+                for sid, record in bd._anchor.iter_unpack(self._map[start:start + count * bd._anchor.size])}
+
+    def read(self, record: int) -> Dict[str, Any]:
+        pos = self.entry(record)[0]
+
+        def read_exact(n):
+            nonlocal pos
+            data = self._map[pos:pos + n]
+            if len(data) != n:
+                raise ValueError("Файл обрезан")
+            pos += n
+            return data
+
+        return BinaryDocument._read_record(read_exact, self.strings)
+
+
+class SegmentedDocument:
+    """Документ из независимых сегментов для параллельного разбора.
+
+    Записи верхнего уровня нарезаны на сегменты по SEGMENT_RECORDS; каждый
+    сегмент - самостоятельный поток BinaryDocument без индекса, со своей
+    таблицей строк, поэтому его можно декодировать отдельно от остальных.
+    После заголовка лежит оглавление: смещение, длина и число записей сегмента.
+    Стрелки ссылаются на концы по id и связываются уже после сборки всех сегментов.
+    """
+    MAGIC = b'FIGS'
+    VERSION = 1
+    SEGMENT_RECORDS = 50000
+
+    _header = struct.Struct('<4sHI')
+    # смещение, длина, число записей
+    _segment = struct.Struct('<QQI')
+
+    @classmethod
+    def is_segmented(cls, filename: str) -> bool:
+        with open(filename, 'rb') as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def write(cls, f, components: List[Component], progress=None):
+        parts = [components[i:i + cls.SEGMENT_RECORDS]
+                 for i in range(0, len(components), cls.SEGMENT_RECORDS)]
+        start = f.tell()
+        f.write(cls._header.pack(cls.MAGIC, cls.VERSION, len(parts)))
+        f.write(bytes(cls._segment.size * len(parts)))
+        table = []
+        for i, part in enumerate(parts):
+            if progress:
+                progress(i * cls.SEGMENT_RECORDS, len(components))
+            offset = f.tell()
+            BinaryDocument.write(f, part, index=False)
+            table.append(cls._segment.pack(offset, f.tell() - offset, len(part)))
+        end = f.tell()
+        f.seek(start + cls._header.size)
+        f.write(b''.join(table))
+        f.seek(end)
+
+    @classmethod
+    def segments(cls, filename: str) -> List[Tuple[int, int, int]]:
+        with open(filename, 'rb') as f:
+            magic, version, count = cls._header.unpack(f.read(cls._header.size))
+            if magic != cls.MAGIC:
+                raise ValueError("Не сегментированный документ")
+            if version > cls.VERSION:
+                raise ValueError(f"Неподдерживаемая версия: {version}")
+            table = f.read(cls._segment.size * count)
+        if len(table) != cls._segment.size * count:
+            raise ValueError("Файл обрезан")
+        return list(cls._segment.iter_unpack(table))
+
+    @staticmethod
+    def decode(filename: str, offset: int, length: int) -> List[Dict[str, Any]]:
+        """Записи одного сегмента; цвета - числа ARGB, чтобы результат легко передавался между процессами."""
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        return list(BinaryDocument.read(io.BytesIO(data), int))
+
+    @classmethod
+    def read(cls, filename: str, progress=None, workers: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Записи верхнего уровня всех сегментов по порядку.
+
+        Сегменты декодируются в пуле процессов (workers, по умолчанию по числу
+        ядер); в этом процессе остаётся только склейка списков. Один сегмент
+        разбирается на месте, без запуска пула.
+        """
+        segments = cls.segments(filename)
+        total = sum(count for _, _, count in segments)
+        records: List[Dict[str, Any]] = []
+        if len(segments) < 2 or workers == 1:
+            for offset, length, count in segments:
+                records.extend(cls.decode(filename, offset, length))
+                if progress:
+                    progress(len(records), total)
+            return records
+        # spawn: fork процесса с GUI и фоновыми потоками небезопасен
+        pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            futures = [pool.submit(cls.decode, filename, offset, length) for offset, length, _ in segments]
+            for future in futures:
+                records.extend(future.result())
+                if progress:
+                    progress(len(records), total)
+        finally:
+            pool.shutdown(cancel_futures=True)
+        return records
+
+
+class _LazyRecord:
+    """Ещё не загруженная запись MappedDocument в контейнере.
+
+    Хранит только ссылку на документ и номер записи; область отрисовки и флаг
+    выделения читаются из индекса. Контейнер подменяет заглушку настоящим
+    компонентом, прежде чем отдать её наружу.
+    """
+    __slots__ = ('document', 'record')
+
+    def __init__(self, document: MappedDocument, record: int):
+        self.document = document
+        self.record = record
+
+    @property
+    def is_selected(self) -> bool:
+        return bool(self.document.entry(self.record)[2] & BinaryDocument.FLAG_SELECTED)
+
+    def get_paint_rect(self) -> tuple:
+        return self.document.entry(self.record)[3:]
+
+    def get_children(self) -> list:
+        return []
+
+
+class SpatialIndex:
+    """Равномерная сетка: ячейка -> множество компонентов, чьи рамки её задевают.
+
+    Компоненты, задевающие больше MAX_CELLS ячеек (длинные стрелки, большие
+    группы), в сетку не попадают: они хранятся с рамкой отдельно и проверяются
+    перебором, иначе каждый их сдвиг переписывал бы сотни ячеек.
+    """
+    MAX_CELLS = 16
+
+    def __init__(self, cell_size: int = 128, margin: float = 15):
+        self._cell = cell_size
+        self._margin = margin
+        self._cells: Dict[Tuple[int, int], Set[Component]] = defaultdict(set)
+        # компонент -> диапазон ячеек (x0, y0, x1, y1), которые он задевает
+        self._keys: Dict[Component, Tuple[int, int, int, int]] = {}
+        self._large: Dict[Component, Tuple[float, float, float, float]] = {}
+
+    def _span(self, item: Component):
+        x, y, w, h = item.get_paint_rect()
+        c = self._cell
+        m = self._margin
+        return (int((x - m) // c), int((y - m) // c), int((x + w + m) // c), int((y + h + m) // c)), (x, y, w, h)
+
+    def insert(self, item: Component, span=None):
+        (x0, y0, x1, y1), (x, y, w, h) = span or self._span(item)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > self.MAX_CELLS:
+            m = self._margin
+            self._large[item] = (x - m, y - m, x + w + m, y + h + m)
+            return
+        self._keys[item] = (x0, y0, x1, y1)
+        cells = self._cells
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                cells[(i, j)].add(item)
+
+    def remove(self, item: Component):
+        if self._large.pop(item, None) is not None:
+            return
+        span = self._keys.pop(item, None)
+        if span is None:
+            return
+        x0, y0, x1, y1 = span
+        for i in range(x0, x1 + 1):
+            for j in range(y0, y1 + 1):
+                cell = self._cells[(i, j)]
+                cell.discard(item)
+                if not cell:
+                    del self._cells[(i, j)]
+
+    def update(self, item: Component):
+        span = self._span(item)
+        # при мелком сдвиге компонент обычно остаётся в тех же ячейках
+        if self._keys.get(item) == span[0]:
+            return
+        self.remove(item)
+        self.insert(item, span)
+
+    def clear(self):
+        self._cells.clear()
+        self._keys.clear()
+        self._large.clear()
+
+    def query_point(self, x, y) -> Set[Component]:
+        key = (int(x // self._cell), int(y // self._cell))
+        result = set(self._cells.get(key, ()))
+        for item, (x0, y0, x1, y1) in self._large.items():
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                result.add(item)
+        return result
+
+    def query_rect(self, x, y, w, h) -> Set[Component]:
+        result = set()
+        c = self._cell
+        for i in range(int(x // c), int((x + w) // c) + 1):
+            for j in range(int(y // c), int((y + h) // c) + 1):
+                cell = self._cells.get((i, j))
+                if cell:
+                    result |= cell
+        for item, (x0, y0, x1, y1) in self._large.items():
+            if x0 <= x + w and x <= x1 and y0 <= y + h and y <= y1:
+                result.add(item)
+        return result
+
+
+class Command(ABC):
+    """Шаг истории правок - компактная дельта, а не снимок документа."""
+    # сколько ссылок и строк держит команда, по сумме ограничивается память истории
+    size = 1
+
+    @abstractmethod
+    def undo(self, container: 'FiguresContainer'): pass
+
+    @abstractmethod
+    def redo(self, container: 'FiguresContainer'): pass
+
+    def merge(self, other: 'Command') -> bool:
+        """Поглощает следующую команду того же жеста (шаги перетаскивания)."""
+        return False
+
+
+class MoveCommand(Command):
+    def __init__(self, components: List[Component], dx, dy):
+        self.components = components
+        self.dx = dx
+        self.dy = dy
+        self.size = len(components)
+
+    def undo(self, container):
+        container._translate(self.components, -self.dx, -self.dy)
+
+    def redo(self, container):
+        container._translate(self.components, self.dx, self.dy)
+
+    def merge(self, other):
+        if isinstance(other, MoveCommand) and other.components == self.components:
+            self.dx += other.dx
+            self.dy += other.dy
+            return True
+        return False
+
+
+class ResizeCommand(Command):
+    """Геометрия всех листьев до и после изменения размеров.
+
+    Номера строк не хранятся: удаление и вставка переносят листья между
+    хранилищами, поэтому строки берутся у компонентов заново при применении.
+    """
+
+    def __init__(self, components: List[Component], before, after):
+        self.components = components
+        self.before = before
+        self.after = after
+        self.size = len(components) + 8 * len(before[0])
+
+    def undo(self, container):
+        container._restore_geometry(self.components, self.before)
+
+    def redo(self, container):
+        container._restore_geometry(self.components, self.after)
+
+    def merge(self, other):
+        if isinstance(other, ResizeCommand) and other.components == self.components:
+            self.after = other.after
+            return True
+        return False
+
+
+class RestyleCommand(Command):
+    """Прежние цвета листьев (столбец ShapeStore) и стрелок, новый цвет."""
+
+    def __init__(self, components: List[Component], before, arrows: List['Arrow'],
+                 arrow_colors: List[QColor], color: QColor):
+        self.components = components
+        self.before = before
+        self.arrows = arrows
+        self.arrow_colors = arrow_colors
+        self.color = color
+        self.size = len(components) + 2 * len(before[0])
+
+    def undo(self, container):
+        container._restore_colors(self.components, self.before, self.arrows, self.arrow_colors)
+
+    def redo(self, container):
+        container._recolor(self.components, self.color)
+
+
+class StructureCommand(Command):
+    """Вставка, удаление, группировка и разгруппировка.
+
+    removed и added - записи (компонент, z, выделен) до и после действия,
+    relinks - (стрелка, концы до, концы после), groups - (группа, дети,
+    True если после действия дети лежат в группе).
+    """
+
+    def __init__(self, removed, added, relinks=(), groups=()):
+        self.removed = list(removed)
+        self.added = list(added)
+        self.relinks = list(relinks)
+        self.groups = list(groups)
+        self.size = len(self.removed) + len(self.added) + len(self.relinks)
+
+    def undo(self, container):
+        container._restructure(self.added, self.removed, self.relinks, self.groups, False)
+
+    def redo(self, container):
+        container._restructure(self.removed, self.added, self.relinks, self.groups, True)
+
+
+class History:
+    """Стеки отмены и повтора.
+
+    Память ограничена и числом шагов, и суммарным размером команд: старые шаги
+    вытесняются первыми. Подряд идущие команды одного жеста сливаются, пока
+    seal() не закроет жест.
+    """
+
+    def __init__(self, max_steps: int = 200, max_size: int = 2_000_000):
+        self.max_steps = max_steps
+        self.max_size = max_size
+        self._undo: deque = deque()
+        self._redo: List[Command] = []
+        self._size = 0
+        self._open = False
+
+    def push(self, command: Command):
+        for dropped in self._redo:
+            self._size -= dropped.size
+        self._redo.clear()
+        if self._open and self._undo and self._undo[-1].merge(command):
+            return
+        self._undo.append(command)
+        self._size += command.size
+        self._open = True
+        while len(self._undo) > 1 and (len(self._undo) > self.max_steps or self._size > self.max_size):
+            self._size -= self._undo.popleft().size
+
+    def seal(self):
+        self._open = False
+
+    def undo(self, container: 'FiguresContainer') -> bool:
+        if not self._undo:
+            return False
+        self._open = False
+        command = self._undo.pop()
+        command.undo(container)
+        self._redo.append(command)
+        return True
+
+    def redo(self, container: 'FiguresContainer') -> bool:
+        if not self._redo:
+            return False
+        self._open = False
+        command = self._redo.pop()
+        command.redo(container)
+        self._undo.append(command)
+        return True
+
+    def clear(self):
+        self._undo.clear()
+        self._redo.clear()
+        self._size = 0
+        self._open = False
+
+    @property
+    def can_undo(self) -> bool:
+        return bool(self._undo)
+
+    @property
+    def can_redo(self) -> bool:
+        return bool(self._redo)
+
+
 class FiguresContainer(Subject):
+    # больше изменённых компонентов - событие просит перерисовать весь холст
+    MAX_EVENT_RECTS = 256
+    # расширение -> формат файла; остальные пишутся в JSON
+    LAYOUTS = {'.figb': 'binary', '.figs': 'segmented'}
+
     def __init__(self):
         super().__init__()
         self._shapes: List[Component] = []
+        self._index = SpatialIndex()
+        # порядковый номер вставки = z-порядок, _shapes всегда отсортирован по нему
+        self._z: Dict[Component, int] = {}
+        self._next_z = 0
+        # строки листьев документа; удалённый компонент уносит свои в отдельное хранилище
+        self.store = ShapeStore()
+        # строка ShapeStore листа -> компонент верхнего уровня, которому он принадлежит
+        self._row_owner: Dict[int, Component] = {}
+        self._row_holders: Set[Component] = set()
+        self._rows_array = None
+        self._lazy_count = 0
+        # отображённый файл, из которого загружаются заглушки _LazyRecord
+        self._document: Optional[MappedDocument] = None
+        self._arrows: Set[Arrow] = set()
+        self._by_z: Dict[int, Component] = {}
+        # выделенные компоненты верхнего уровня в порядке выделения (dict как упорядоченное множество)
+        self._selected: Dict[Component, None] = {}
+        # смежность стрелок: конец -> стрелки, выходящие из него / входящие в него
+        self._arrows_from: Dict[Component, Set[Arrow]] = defaultdict(set)
+        self._arrows_to: Dict[Component, Set[Arrow]] = defaultdict(set)
+        self.history = History()
+
+    def _take_z(self) -> int:
+        z = self._next_z
+        self._next_z += 1
+        return z
+
+    def _insert(self, shape: Component, z: Optional[int] = None) -> int:
+        """Вставляет компонент на его место в z-порядке (по умолчанию - наверх), возвращает строку."""
+        if z is None:
+            z = self._take_z()
+        else:
+            self._next_z = max(self._next_z, z + 1)
+        if not self._shapes or self._z[self._shapes[-1]] < z:
+            row = len(self._shapes)
+            self._shapes.append(shape)
+        else:
+            row = bisect.bisect_left(self._shapes, z, key=self._z.__getitem__)
+            self._shapes.insert(row, shape)
+        self._z[shape] = z
+        self._by_z[z] = shape
+        self._index.insert(shape)
+        if not isinstance(shape, _LazyRecord):
+            shape._rehome(self.store)
+        self._own_rows(shape)
+        if isinstance(shape, Arrow):
+            self._arrows.add(shape)
+            self._link(shape)
+        if shape.is_selected:
+            self._selected[shape] = None
+        return row
+
+    def _discard(self, shape: Component, detached: ShapeStore) -> int:
+        """Убирает компонент; строки его листьев освобождаются в store и переезжают в detached."""
+        row = bisect.bisect_left(self._shapes, self._z[shape], key=self._z.__getitem__)
+        del self._shapes[row]
+        del self._by_z[self._z.pop(shape)]
+        self._index.remove(shape)
+        self._disown_rows(shape)
+        if not isinstance(shape, _LazyRecord):
+            shape._rehome(detached)
+        if isinstance(shape, Arrow):
+            self._arrows.discard(shape)
+            self._unlink(shape)
+        self._selected.pop(shape, None)
+        return row
+
+    # состояние документа: _adopt забирает его целиком у контейнера, собранного в стороне
+    _STATE = ('_shapes', '_index', '_z', '_next_z', 'store', '_row_owner', '_row_holders', '_rows_array',
+              '_lazy_count', '_document', '_arrows', '_by_z', '_selected', '_arrows_from', '_arrows_to')
+
+    def _adopt(self, staging: 'FiguresContainer'):
+        old = self._document
+        for name in self._STATE:
+            setattr(self, name, getattr(staging, name))
+        self.history.clear()
+        if old is not None and old is not self._document:
+            old.close()
+
+    def detach_document(self):
+        """Загружает оставшиеся заглушки и закрывает отображённый файл.
+
+        Зовётся перед сохранением: файл документа можно перезаписать, только
+        когда отображение закрыто.
+        """
+        if self._document is None:
+            return
+        for shape in self._shapes:
+            self._real(shape)
+        self._document.close()
+        self._document = None
+
+    def _leaf_rows(self, component, out: List[int]):
+        if isinstance(component, Shape):
+            out.append(component._row)
+        else:
+            for child in component.get_children():
+                self._leaf_rows(child, out)
+
+    def _own_rows(self, shape):
+        if isinstance(shape, (Arrow, _LazyRecord)):
+            return
+        rows = []
+        self._leaf_rows(shape, rows)
+        for r in rows:
+            self._row_owner[r] = shape
+        self._row_holders.add(shape)
+        self._rows_array = None
+
+    def _disown_rows(self, shape):
+        if shape not in self._row_holders:
+            return
+        self._row_holders.discard(shape)
+        rows = []
+        self._leaf_rows(shape, rows)
+        for r in rows:
+            del self._row_owner[r]
+        self._rows_array = None
+
+    def _row_columns(self):
+        """Строки листьев, z их владельцев и число листьев у каждого владельца (по возрастанию z)."""
+        if self._rows_array is None:
+            n = len(self._row_owner)
+            rows = np.fromiter(self._row_owner, dtype=np.intp, count=n)
+            owner_z = np.fromiter((self._z[o] for o in self._row_owner.values()), dtype=np.int64, count=n)
+            owners, totals = np.unique(owner_z, return_counts=True)
+            self._rows_array = (rows, owner_z, owners, totals)
+        return self._rows_array
+
+    def _load_lazy_in(self, x, y, w, h):
+        if self._lazy_count:
+            for shape in self._index.query_rect(x, y, w, h):
+                self._real(shape)
+
+    def _link(self, arrow: 'Arrow'):
+        if arrow.source is not None:
+            self._arrows_from[arrow.source].add(arrow)
+        if arrow.target is not None:
+            self._arrows_to[arrow.target].add(arrow)
+
+    def _unlink(self, arrow: 'Arrow'):
+        for table, end in ((self._arrows_from, arrow.source), (self._arrows_to, arrow.target)):
+            if end is None:
+                continue
+            arrows = table.get(end)
+            if arrows is not None:
+                arrows.discard(arrow)
+                if not arrows:
+                    del table[end]
+
+    def _arrows_of(self, component: Component) -> Set['Arrow']:
+        """Стрелки, у которых компонент - начало или конец (без вложенных компонентов)."""
+        return self._arrows_from.get(component, set()) | self._arrows_to.get(component, set())
+
+    def _attached_arrows(self, shapes: List[Component]) -> List['Arrow']:
+        if not self._arrows:
+            return []
+        affected = set()
+        for shape in shapes:
+            self._collect(shape, affected)
+        attached = set()
+        for component in affected:
+            attached |= self._arrows_of(component)
+        return list(attached)
+
+    def dragged_with(self, components: List[Component]) -> List[Component]:
+        """Всё, что меняет вид при сдвиге components: они сами и прикреплённые стрелки, в z-порядке."""
+        return sorted(set(components).union(self._attached_arrows(components)), key=self._z.__getitem__)
+
+    def _track_selection(self, shape: Component):
+        if shape not in self._z:
+            return
+        if shape.is_selected:
+            self._selected[shape] = None
+        else:
+            self._selected.pop(shape, None)
+
+    def _collect(self, component, result):
+        result.add(component)
+        for child in component.get_children():
+            self._collect(child, result)
+
+    @staticmethod
+    def _paint_rect(component: Component) -> QRect:
+        x, y, w, h = component.get_paint_rect()
+        return QRect(int(x) - 1, int(y) - 1, int(w) + 3, int(h) + 3)
+
+    def _record(self, command: Command):
+        self.history.push(command)
+
+    def _execute(self, command: Command):
+        command.redo(self)
+        self._record(command)
+
+    def undo(self) -> bool:
+        return self.history.undo(self)
+
+    def redo(self) -> bool:
+        return self.history.redo(self)
+
+    def seal_history(self):
+        """Закрывает жест: следующая команда не сольётся с предыдущей."""
+        self.history.seal()
+
+    def _rects(self, components: List[Component]) -> List[QRect]:
+        if len(components) > self.MAX_EVENT_RECTS:
+            return self._bounds(components)
+        return [self._paint_rect(c) for c in components]
+
+    @staticmethod
+    def _bounds(components: List[Component]) -> List[QRect]:
+        """Одна общая рамка областей отрисовки - для событий с множеством компонентов."""
+        if not components:
+            return []
+        rects = [c.get_paint_rect() for c in components]
+        x0 = min(r[0] for r in rects)
+        y0 = min(r[1] for r in rects)
+        x1 = max(r[0] + r[2] for r in rects)
+        y1 = max(r[1] + r[3] for r in rects)
+        return [QRect(int(x0) - 1, int(y0) - 1, math.ceil(x1) - int(x0) + 3, math.ceil(y1) - int(y0) + 3)]
+
+    def _take_out(self, components: List[Component]) -> List[tuple]:
+        """Убирает компоненты одним событием REMOVED, возвращает записи (компонент, z, выделен)."""
+        items = sorted(components, key=self._z.__getitem__, reverse=True)
+        records = [(c, self._z[c], c.is_selected) for c in items]
+        rects = self._rects(items)
+        detached = ShapeStore()
+        rows = [self._discard(c, detached) for c in items]
+        if items:
+            self.notify_change(ChangeEvent(ChangeKind.REMOVED, items, rows, rects))
+        return records
+
+    def _put_back(self, records: List[tuple]):
+        """Вставляет компоненты на их z одним событием INSERTED."""
+        records = sorted(records, key=lambda r: r[1])
+        rows = []
+        for component, z, selected in records:
+            component.is_selected = selected
+            rows.append(self._insert(component, z))
+        if records:
+            components = [r[0] for r in records]
+            self.notify_change(ChangeEvent(ChangeKind.INSERTED, components, rows, self._rects(components)))
+
+    def _relink(self, arrows: List[tuple]):
+        """arrows - пары (стрелка, (начало, конец))."""
+        touched = [arrow for arrow, _ in arrows]
+        rects = self._rects(touched)
+        for arrow, (source, target) in arrows:
+            self._unlink(arrow)
+            arrow.source, arrow.target = source, target
+            self._link(arrow)
+            if arrow in self._z:
+                self._index.update(arrow)
+        rects.extend(self._rects(touched))
+        self.notify_change(ChangeEvent(ChangeKind.RELINKED, touched, rects=rects))
+
+    def _restructure(self, take, put, relinks, groups, forward: bool):
+        self._take_out([c for c, _, _ in take])
+        for group, children, bound in groups:
+            if bound == forward:
+                group._adopt(children)
+            else:
+                group._release()
+        if relinks:
+            self._relink([(arrow, after if forward else before) for arrow, before, after in relinks])
+        self._put_back(put)
 
     def add(self, shape: Component):
-        self._shapes.append(shape)
-        self.notify()
+        row = self._insert(shape)
+        self.notify_change(ChangeEvent(ChangeKind.INSERTED, [shape], [row], [self._paint_rect(shape)]))
+        self._record(StructureCommand([], [(shape, self._z[shape], shape.is_selected)]))
 
     def remove(self, shape: Component):
-        if shape in self._shapes:
-            to_remove = [shape]
-            if not isinstance(shape, Arrow):
-                arrows = [s for s in self._shapes if isinstance(s, Arrow) and (s.source == shape or s.target == shape)]
-                to_remove.extend(arrows)
-            for item in to_remove:
-                if item in self._shapes:
-                    self._shapes.remove(item)
-            self.notify()
+        self._remove_all([shape])
+
+    def _remove_all(self, shapes: List[Component]):
+        """Удаляет компоненты вместе с прикреплёнными к ним стрелками одним событием."""
+        shapes = [s for s in shapes if s in self._z]
+        if not shapes:
+            return
+        to_remove = set(shapes)
+        to_remove.update(a for a in self._attached_arrows(shapes) if a in self._z)
+        self._record(StructureCommand(self._take_out(list(to_remove)), []))
+
+    def _transform(self, shape: Component, apply) -> bool:
+        touched = [shape] + self._attached_arrows([shape])
+        rects = [self._paint_rect(c) for c in touched]
+        if not apply():
+            return False
+        for c in touched:
+            if c in self._z:
+                self._index.update(c)
+            rects.append(self._paint_rect(c))
+        self.notify_change(ChangeEvent(ChangeKind.MOVED, touched, rects=rects))
+        return True
+
+    def move(self, shape: Component, dx, dy, fw, fh) -> bool:
+        if not self._transform(shape, lambda: shape.move(dx, dy, fw, fh)):
+            return False
+        self._record(MoveCommand([shape], dx, dy))
+        return True
+
+    def resize_shape(self, shape: Component, dw, dh, fw, fh) -> bool:
+        return self.resize_many([shape], dw, dh, fw, fh)
+
+    def _rows_of(self, shapes: List[Component]) -> List[int]:
+        """Строки store всех листьев набора фигур и групп из документа."""
+        rows = [s._row for s in shapes if isinstance(s, Shape)]
+        for s in shapes:
+            if isinstance(s, Group):
+                rows.extend(s._leaf_layout()[0])
+        return rows
+
+    def _transform_many(self, shapes: List[Component], apply) -> bool:
+        if not shapes:
+            return False
+        touched = shapes + self._attached_arrows(shapes)
+        # много компонентов - старая и новая общие рамки вместо рамки на каждый
+        rects_of = self._bounds if len(touched) > self.MAX_EVENT_RECTS // 2 else self._rects
+        rects = rects_of(touched)
+        if not apply(shapes):
+            return False
+        for c in touched:
+            if c in self._z:
+                self._index.update(c)
+        rects.extend(rects_of(touched))
+        self.notify_change(ChangeEvent(ChangeKind.MOVED, touched, rects=rects))
+        return True
+
+    def _shift(self, shapes: List[Component], dx, dy) -> bool:
+        self.store.translate(self._rows_of(shapes), dx, dy)
+        for s in shapes:
+            if isinstance(s, Group):
+                s._shifted(dx, dy)
+            s._changed()
+        return True
+
+    def _rows_changed(self, shapes: List[Component]):
+        # строки изменены в обход move()/resize_shape(): кэши рамок групп устарели
+        for s in shapes:
+            if isinstance(s, Group):
+                s._forget_bounds()
+            s._changed()
+
+    def _translate(self, shapes: List[Component], dx, dy):
+        self._transform_many(shapes, lambda shapes: self._shift(shapes, dx, dy))
+
+    def _restore_geometry(self, shapes: List[Component], saved):
+        def apply(shapes):
+            self.store.restore(self._rows_of(shapes), saved)
+            self._rows_changed(shapes)
+            return True
+        self._transform_many(shapes, apply)
+
+    def move_many(self, shapes: List[Component], dx, dy, fw, fh) -> bool:
+        """Сдвигает набор компонентов как одно целое одним событием.
+
+        Сдвиг ограничивается общей рамкой набора: у края холста останавливается
+        весь набор, а не отдельные фигуры. Листья сдвигаются одним проходом
+        ShapeStore.translate.
+        """
+        shapes = [s for s in shapes if not isinstance(s, Arrow)]
+
+        def apply(shapes):
+            nonlocal dx, dy
+            rects = [s.get_bounding_rect() for s in shapes]
+            x0 = min(r[0] for r in rects)
+            y0 = min(r[1] for r in rects)
+            x1 = max(r[0] + r[2] for r in rects)
+            y1 = max(r[1] + r[3] for r in rects)
+            # уже вылезший за край набор не выталкивается обратно, только не сдвигается дальше
+            dx = min(max(dx, min(0, -x0)), max(0, fw - x1))
+            dy = min(max(dy, min(0, -y0)), max(0, fh - y1))
+            if not dx and not dy:
+                return False
+            return self._shift(shapes, dx, dy)
+        if not self._transform_many(shapes, apply):
+            return False
+        self._record(MoveCommand(shapes, dx, dy))
+        return True
+
+    def resize_many(self, shapes: List[Component], dw, dh, fw, fh) -> bool:
+        """Меняет размер набора компонентов: либо у всех, либо ни у одного."""
+        shapes = [s for s in shapes if not isinstance(s, Arrow)]
+        rows = self._rows_of(shapes) if shapes else []
+        saved = None
+
+        def apply(shapes):
+            nonlocal saved
+            saved = self.store.snapshot(rows)
+            if all(s.resize_shape(dw, dh, fw, fh) for s in shapes):
+                return True
+            self.store.restore(rows, saved)
+            self._rows_changed(shapes)
+            return False
+        if not self._transform_many(shapes, apply):
+            return False
+        self._record(ResizeCommand(shapes, saved, self.store.snapshot(rows)))
+        return True
+
+    def set_selected(self, shape: Component, value: bool):
+        if shape.is_selected != value:
+            shape.is_selected = value
+            self._track_selection(shape)
+            self.notify_change(ChangeEvent(ChangeKind.SELECTION, [shape], rects=[self._paint_rect(shape)]))
+
+    def set_color(self, shape: Component, color: QColor):
+        self.restyle([shape], color)
+
+    def restyle(self, shapes: List[Component], color: QColor):
+        """Перекрашивает набор компонентов одним событием."""
+        if not shapes:
+            return
+        arrows = [s for s in shapes if isinstance(s, Arrow)]
+        rows = self._rows_of([s for s in shapes if not isinstance(s, Arrow)])
+        before = self.store.snapshot(rows, ShapeStore.COLOR)
+        arrow_colors = [a.color for a in arrows]
+        self._recolor(shapes, color)
+        self._record(RestyleCommand(shapes, before, arrows, arrow_colors, color))
+
+    def _recolor(self, shapes: List[Component], color: QColor):
+        for s in shapes:
+            s.set_color(color)
+        self.notify_change(ChangeEvent(ChangeKind.RESTYLED, shapes, rects=self._rects(shapes)))
+
+    def _restore_colors(self, shapes, before, arrows, arrow_colors):
+        rows = self._rows_of([s for s in shapes if not isinstance(s, Arrow)])
+        self.store.restore(rows, before, ShapeStore.COLOR)
+        for arrow, color in zip(arrows, arrow_colors):
+            arrow.color = color
+        self.notify_change(ChangeEvent(ChangeKind.RESTYLED, shapes, rects=self._rects(shapes)))
+
+    def _real(self, shape) -> Component:
+        """Подменяет заглушку _LazyRecord загруженным компонентом на том же месте."""
+        if not isinstance(shape, _LazyRecord):
+            return shape
+        real = self._build(shape.document.read(shape.record))
+        z = self._z[shape]
+        pos = bisect.bisect_left(self._shapes, z, key=self._z.__getitem__)
+        self._shapes[pos] = real
+        del self._z[shape]
+        self._z[real] = z
+        self._by_z[z] = real
+        if shape in self._selected:
+            del self._selected[shape]
+            self._selected[real] = None
+        self._index.remove(shape)
+        self._index.insert(real)
+        self._own_rows(real)
+        self._lazy_count -= 1
+        return real
+
+    def hit_test(self, x, y) -> List[Component]:
+        """Все компоненты верхнего уровня под точкой, в z-порядке (верхний - последний).
+
+        Предикаты фигур считаются сразу для всех строк ShapeStore через NumPy;
+        без NumPy - через пространственный индекс и contains().
+        """
+        point = QPointF(x, y)
+        self._load_lazy_in(x, y, 0, 0)
+        if np is None or not self._row_owner:
+            found = [s for s in self._index.query_point(x, y) if s.contains(point)]
+            return sorted(found, key=self._z.__getitem__)
+        rows, owner_z, _, _ = self._row_columns()
+        mask = self.store.hits_point(rows, x, y)
+        hit_rows = None
+        found = []
+        for z in np.unique(owner_z[mask]).tolist():
+            owner = self._by_z[z]
+            if isinstance(owner, Group):
+                if owner._leaf_layout()[1]:
+                    if hit_rows is None:
+                        hit_rows = set(rows[mask].tolist())
+                    if not self._group_hit(owner, x, y, hit_rows):
+                        continue
+                else:
+                    gx, gy, gw, gh = owner.get_bounding_rect()
+                    if not (gx <= x <= gx + gw and gy <= y <= gy + gh):
+                        continue
+            found.append(owner)
+        # стрелки лежат в пространственном индексе по рамке концов
+        return self._merge_arrows(found, [a for a in self._index.query_point(x, y)
+                                          if isinstance(a, Arrow) and a.contains(point)])
+
+    @classmethod
+    def _group_hit(cls, group: Group, x, y, hit_rows: Set[int]) -> bool:
+        """Group.contains() по уже посчитанным попаданиям листьев: рамка проверяется на каждом уровне."""
+        gx, gy, gw, gh = group.get_bounding_rect()
+        if not (gx <= x <= gx + gw and gy <= y <= gy + gh):
+            return False
+        return any(cls._group_hit(child, x, y, hit_rows) if isinstance(child, Group) else child._row in hit_rows
+                   for child in group._children)
+
+    def _merge_arrows(self, found: List[Component], arrows: List['Arrow']) -> List[Component]:
+        # стрелок мало, вставка в уже упорядоченный по z список дешевле сортировки
+        for arrow in arrows:
+            bisect.insort(found, arrow, key=self._z.__getitem__)
+        return found
+
+    def components_in_rect(self, x, y, w, h) -> List[Component]:
+        """Компоненты верхнего уровня, целиком лежащие в прямоугольнике, в z-порядке."""
+        self._load_lazy_in(x, y, w, h)
+        x1, y1 = x + w, y + h
+
+        def inside(c):
+            cx, cy, cw, ch = c.get_bounding_rect()
+            return x <= cx and cx + cw <= x1 and y <= cy and cy + ch <= y1
+
+        if np is None or not self._row_owner:
+            found = [c for c in self._index.query_rect(x, y, w, h) if inside(c)]
+            return sorted(found, key=self._z.__getitem__)
+        rows, owner_z, owners, totals = self._row_columns()
+        zs, counts = np.unique(owner_z[self.store.inside_rect(rows, x, y, x1, y1)], return_counts=True)
+        # группа выбирается, только если внутри все её листья
+        zs = zs[counts == totals[np.searchsorted(owners, zs)]]
+        by_z = self._by_z
+        found = [by_z[z] for z in zs.tolist()]
+        return self._merge_arrows(found, [a for a in self._index.query_rect(x, y, w, h)
+                                          if isinstance(a, Arrow) and inside(a)])
+
+    def set_selection(self, shapes: List[Component], value: bool):
+        """Выделяет или снимает выделение с набора компонентов одним событием."""
+        changed = [s for s in shapes if s.is_selected != value]
+        if not changed:
+            return
+        for s in changed:
+            s.is_selected = value
+            self._track_selection(s)
+        rects = self._rects(changed)
+        self.notify_change(ChangeEvent(ChangeKind.SELECTION, changed, rects=rects))
+
+    def get_in_rect(self, x, y, w, h) -> List[Component]:
+        """Компоненты, чьи области отрисовки задевают прямоугольник, в z-порядке."""
+        found = sorted(self._index.query_rect(x, y, w, h), key=self._z.__getitem__)
+        return [self._real(s) for s in found]
+
+    def topmost_at(self, point) -> Optional[Component]:
+        candidates = self._index.query_point(point.x(), point.y())
+        for shape in sorted(candidates, key=self._z.__getitem__, reverse=True):
+            shape = self._real(shape)
+            if shape.contains(point):
+                return shape
+        return None
 
     def get_all(self):
-        return self._shapes.copy()
+        return [self._real(s) for s in self._shapes]
+
+    def get_range(self, start: int, stop: int) -> List[Component]:
+        return [self._real(s) for s in self._shapes[start:stop]]
+
+    def count(self) -> int:
+        return len(self._shapes)
 
     def clear_selected(self):
-        for s in [s for s in self._shapes if s.is_selected]:
-            self.remove(s)
+        self._remove_all(self.get_selected())
 
-    def get_selected(self):
-        return [s for s in self._shapes if s.is_selected]
+    def get_selected(self) -> List[Component]:
+        """Выделенные компоненты верхнего уровня в порядке выделения."""
+        return [self._real(s) for s in list(self._selected)]
 
     def group_selected(self):
         selected = [s for s in self.get_selected() if not isinstance(s, Arrow)]
         if len(selected) < 2: return None
+        selected.sort(key=self._z.__getitem__)
         group = Group()
-        for s in selected:
-            self._shapes.remove(s)
-            group.add(s)
-            s.is_selected = False
-        self._shapes.append(group)
-        group.is_selected = True
-        self.notify()
+        members = [(s, self._z[s], s.is_selected) for s in selected]
+        self._execute(StructureCommand(members, [(group, self._take_z(), True)],
+                                       groups=[(group, selected, True)]))
         return group
 
     def ungroup_selected(self):
-        changed = False
-        for shape in list(self._shapes):
-            if isinstance(shape, Group) and shape.is_selected:
-                children = shape.get_children()
-                for fig in self._shapes:
-                    if isinstance(fig, Arrow):
-                        if fig.source == shape:
-                            fig.source = children[0] if children else None
-                        if fig.target == shape:
-                            fig.target = children[0] if children else None
-                self._shapes.remove(shape)
-                for child in children:
-                    child.is_selected = True
-                    self._shapes.append(child)
-                changed = True
-        if changed:
-            self.notify()
-
-    def save_to_file(self, filename: str) -> bool:
+        groups = [s for s in self.get_selected() if isinstance(s, Group)]
+        if not groups:
+            return
+        removed, added, relinks, bindings = [], [], [], []
+        for group in sorted(groups, key=self._z.__getitem__):
+            children = group.get_children()
+            first = children[0] if children else None
+            removed.append((group, self._z[group], group.is_selected))
+            added.extend((child, self._take_z(), True) for child in children)
+            for arrow in self._arrows_of(group):
+                ends = (arrow.source, arrow.target)
+                relinks.append((arrow, ends, tuple(first if end is group else end for end in ends)))
+            bindings.append((group, children, False))
+        self._execute(StructureCommand(removed, added, relinks, bindings))
+
+    def save_to_file(self, filename: str, binary: Optional[bool] = None) -> bool:
+        """binary=None - формат по расширению (LAYOUTS), иначе JSON.
+
+        binary=True без двоичного расширения - двоичный с индексом, False - JSON.
+        """
+        layout = self.LAYOUTS.get(os.path.splitext(filename)[1].lower(), 'json')
+        if binary is False:
+            layout = 'json'
+        elif binary and layout == 'json':
+            layout = 'binary'
         try:
-            data = {'version': 1.1, 'shapes': [s.save() for s in self._shapes]}
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2)
+            components = self.get_all()
+            self.detach_document()
+            self.write_file(filename, components, layout)
             return True
         except Exception as e:
             print(e)
             return False
 
+    @staticmethod
+    def write_file(filename: str, components: List[Component], layout: str, progress=None):
+        """Пишет компоненты во временный файл и подменяет им filename.
+
+        Прерванная запись (ошибка или отмена из progress) не трогает старый файл.
+        progress(сделано, всего) зовётся по ходу записи; годится для рабочего потока,
+        пока компоненты никто не правит и если для них уже вызван settle().
+        """
+        tmp = filename + '.tmp'
+        try:
+            if layout == 'segmented':
+                with open(tmp, 'wb') as f:
+                    SegmentedDocument.write(f, components, progress)
+            elif layout == 'binary':
+                with open(tmp, 'wb') as f:
+                    BinaryDocument.write(f, components, progress)
+            else:
+                shapes = []
+                for i, c in enumerate(components):
+                    if progress and i % 1024 == 0:
+                        progress(i, len(components))
+                    shapes.append(c.save())
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump({'version': 1.1, 'shapes': shapes}, f, indent=2)
+            os.replace(tmp, filename)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @staticmethod
+    def read_records(filename: str, progress=None) -> List[Dict[str, Any]]:
+        """Записи верхнего уровня файла (формат save()) без сборки компонентов.
+
+        Только разбор, без Qt-виджетов и без состояния контейнера, поэтому годится
+        для рабочего потока. progress(прочитано байт, всего байт).
+        """
+        if SegmentedDocument.is_segmented(filename):
+            return SegmentedDocument.read(filename, progress)
+        size = os.path.getsize(filename)
+        if BinaryDocument.is_binary(filename):
+            records = []
+            with open(filename, 'rb') as f:
+                for record in BinaryDocument.read(f):
+                    records.append(record)
+                    if progress and len(records) % 1024 == 0:
+                        progress(f.tell(), size)
+            return records
+        chunks = []
+        done = 0
+        with open(filename, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                chunks.append(chunk)
+                done += len(chunk)
+                if progress:
+                    progress(done, size)
+        return json.loads(b''.join(chunks).decode('utf-8'))['shapes']
+
     def load_from_file(self, filename: str) -> bool:
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            self._shapes.clear()
-            loaded_shapes = {}
-            arrows_data = []
-            for shape_data in data['shapes']:
-                if shape_data['type'] == 'arrow':
-                    arrows_data.append(shape_data)
-                    continue
-                shape = ShapeFactory.create_shape(shape_data['type'])
-                shape.load(shape_data)
-                self._shapes.append(shape)
-                self._register_ids(shape, loaded_shapes)
-            for arrow_data in arrows_data:
-                dummy = Circle(0, 0)
-                arrow = Arrow(dummy, dummy)
-                arrow.load(arrow_data)
-                src = loaded_shapes.get(arrow._saved_source_id)
-                tgt = loaded_shapes.get(arrow._saved_target_id)
-                if src and tgt:
-                    arrow.source = src
-                    arrow.target = tgt
-                    self._shapes.append(arrow)
+            if BinaryDocument.is_binary(filename):
+                for _ in self.load_binary_steps(filename):
+                    pass
+            else:
+                self.load_records(self.read_records(filename))
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    def recover(self, filename: str) -> bool:
+        """Восстанавливает документ после сбоя: снимок (или сам файл) плюс журнал правок."""
+        try:
+            self.load_records(Journal.recover(filename))
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    def load_records(self, records: List[Dict[str, Any]]):
+        for _ in self.load_steps(records):
+            pass
+
+    def load_steps(self, records, chunk: int = 5000, fraction=None):
+        """Собирает документ из записей по частям и подменяет им текущий целиком.
+
+        Генератор: после каждых chunk записей отдаёт долю готовности, чтобы GUI
+        успевал обрабатывать события. Сборка идёт в отдельном контейнере, текущий
+        документ меняется только в конце, поэтому брошенная или упавшая загрузка
+        его не портит. records - список или поток записей; для потока
+        fraction(собрано записей) считает долю готовности сама.
+        """
+        if fraction is None:
+            fraction = lambda done: done / len(records)
+        staging = FiguresContainer()
+        yield from staging._load_records(records, chunk, fraction)
+        self._adopt(staging)
+        self.notify()
+
+    def load_binary_steps(self, filename: str, chunk: int = 5000):
+        """load_steps для двоичного документа: записи разбираются по мере сборки.
+
+        Список всех записей не собирается, в памяти только сам документ и
+        читаемая запись. Доля готовности - позиция в файле.
+        """
+        size = os.path.getsize(filename) or 1
+        with open(filename, 'rb') as f:
+            yield from self.load_steps(BinaryDocument.read(f, color=int), chunk, lambda done: f.tell() / size)
+
+    def open_mapped(self, filename: str) -> bool:
+        """Открывает индексированный двоичный документ без разбора записей.
+
+        Фигуры остаются заглушками и загружаются из отображённого файла, когда
+        попадают в видимую область Form или в дерево. Стрелки и фигуры, к которым
+        они прикреплены, загружаются сразу. False - файл не индексированный
+        двоичный документ или его не удалось открыть.
+        """
+        try:
+            if not MappedDocument.is_indexed(filename):
+                return False
+            document = MappedDocument(filename)
+            staging = FiguresContainer()
+            staging._document = document
+            try:
+                staging._map_records(document)
+            except Exception:
+                document.close()
+                raise
+            self._adopt(staging)
             self.notify()
             return True
         except Exception as e:
             print(e)
             return False
 
+    def _map_records(self, document: MappedDocument):
+        by_record: List[Optional[_LazyRecord]] = []
+        arrow_records = []
+        for record in range(document.count):
+            if document.entry(record)[1] == BinaryDocument.TAG_ARROW:
+                arrow_records.append(record)
+                by_record.append(None)
+                continue
+            placeholder = _LazyRecord(document, record)
+            by_record.append(placeholder)
+            self._insert(placeholder, record)
+            self._lazy_count += 1
+        if arrow_records:
+            anchors = document.anchors()
+            loaded_shapes = {}
+            for record in arrow_records:
+                arrow_data = document.read(record)
+                for endpoint in (arrow_data['source_id'], arrow_data['target_id']):
+                    holder = anchors.get(endpoint)
+                    if endpoint not in loaded_shapes and holder is not None:
+                        self._register_ids(self._real(by_record[holder]), loaded_shapes)
+                self._link_arrow(arrow_data, loaded_shapes, record)
+
+    def _build(self, data: Dict[str, Any]) -> Component:
+        shape = ShapeFactory.create_shape(data['type'], store=self.store)
+        shape.load(data)
+        return shape
+
+    def _link_arrow(self, arrow_data, registry, z: Optional[int] = None):
+        dummy = Circle(0, 0)
+        arrow = Arrow(dummy, dummy)
+        arrow.load(arrow_data)
+        src = registry.get(arrow._saved_source_id)
+        tgt = registry.get(arrow._saved_target_id)
+        if src and tgt:
+            arrow.source = src
+            arrow.target = tgt
+            self._insert(arrow, z)
+
+    def _load_records(self, records, chunk: int, fraction):
+        loaded_shapes = {}
+        arrows_data = []
+        # z = номер записи: стрелки, связанные после всех фигур, встают на свои места
+        for z, shape_data in enumerate(records):
+            if shape_data['type'] == 'arrow':
+                arrows_data.append((z, shape_data))
+                continue
+            shape = self._build(shape_data)
+            self._insert(shape, z)
+            self._register_ids(shape, loaded_shapes)
+            if z % chunk == chunk - 1:
+                yield fraction(z + 1)
+        for z, arrow_data in arrows_data:
+            self._link_arrow(arrow_data, loaded_shapes, z)
+
     def _register_ids(self, component, registry):
         registry[component.id] = component
         for child in component.get_children():
             self._register_ids(child, registry)
 
 
+class Journal(QObject):
+    """Журнал правок рядом с документом для восстановления после сбоя.
+
+    События контейнера превращаются в записи JSON Lines: вставка и удаление строк
+    верхнего уровня, геометрия и цвет листьев по id, перепривязка стрелок. На
+    диск их пишет фоновый поток. GUI кладёт в очередь только числа и кортежи
+    Component.freeze(), а записи save() и JSON собирает поток. Сдвиги и
+    перекраски копятся и уходят одной записью раз в FLUSH_MS, поэтому
+    перетаскивание пишет запись на интервал, а не на кадр.
+
+    Журнал, переросший COMPACT_BYTES, поток сворачивает в снимок <документ>.checkpoint.
+    Снимок помнит id поглощённого журнала, так что сбой между записью снимка и
+    удалением журнала не применит журнал дважды. Восстановление - снимок (или сам
+    документ) плюс журнал. Документ, заменённый целиком (сигнал changed), пишется
+    новым снимком, и журнал начинается заново.
+
+    Записи ссылаются на номера строк, поэтому после ошибки записи журнал с
+    пропуском уже не годится: поток сообщает её сигналом failed и отбрасывает
+    записи, пока новый снимок не ляжет на диск (тогда - сигнал resumed). Снимок
+    повторяется через RETRY_MS, после MAX_RETRIES неудач подряд журнал
+    останавливается до следующего attach().
+    """
+    COMPACT_BYTES = 4 * 1024 * 1024
+    FLUSH_MS = 250
+    RETRY_MS = 5000
+    MAX_RETRIES = 3
+
+    # сигналы приходят из потока журнала
+    failed = pyqtSignal(str)
+    resumed = pyqtSignal()
+
+    def __init__(self, container: FiguresContainer):
+        super().__init__()
+        self.container = container
+        self.filename: Optional[str] = None
+        # документ заменён или журнал сломан - при flush() пишется снимок
+        self._rebase = False
+        self.failures = 0
+        self.stopped = False
+        # компоненты, чьи геометрия и цвет ещё не ушли в журнал
+        self._geometry: Dict[Component, None] = {}
+        self._colors: Dict[Component, None] = {}
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(self.FLUSH_MS)
+        self._timer.timeout.connect(self.flush)
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+        container.component_changed.connect(self._on_component_changed)
+        container.changed.connect(self._on_container_changed)
+        self.failed.connect(self._on_failed)
+        self.resumed.connect(self._on_resumed)
+
+    @staticmethod
+    def paths(filename: str) -> Tuple[str, str]:
+        return filename + '.journal', filename + '.checkpoint'
+
+    @classmethod
+    def has_recovery(cls, filename: str) -> bool:
+        return any(os.path.exists(p) for p in cls.paths(filename))
+
+    def attach(self, filename: str, reset: bool = True):
+        """Ведёт журнал документа filename; журнал прежнего документа удаляется.
+
+        reset - документ только что открыт или сохранён, старый журнал к нему не
+        относится. Без reset документ восстановлен из журнала: поток сразу
+        сворачивает восстановленное состояние в снимок.
+        """
+        self._timer.stop()
+        self._geometry.clear()
+        self._colors.clear()
+        # открытый или восстановленный документ сам служит основой журнала
+        self._rebase = False
+        self.failures = 0
+        self.stopped = False
+        self._queue.put(('attach', filename, reset, self.filename))
+        self.filename = filename
+
+    def close(self, discard: bool = False):
+        self.flush()
+        self._queue.put(('close', discard))
+        self._thread.join(timeout=5)
+
+    def _post(self, entry: Dict[str, Any]):
+        self._queue.put(('entry', entry))
+
+    def _on_container_changed(self):
+        self._timer.stop()
+        self._geometry.clear()
+        self._colors.clear()
+        if self.filename is None or self.stopped:
+            return
+        # снимок откладывается до flush(): сразу за заменой документа обычно идёт
+        # attach(), и тогда загружать заглушки MappedDocument ради снимка не нужно
+        self._rebase = True
+        self._timer.start()
+
+    def _on_failed(self, message: str):
+        self.failures += 1
+        if self.failures > self.MAX_RETRIES:
+            self.stopped = True
+            self._timer.stop()
+            self._geometry.clear()
+            self._colors.clear()
+            return
+        QTimer.singleShot(self.RETRY_MS, self._retry)
+
+    def _retry(self):
+        if not self.stopped:
+            self._rebase = True
+            self.flush()
+
+    def _on_resumed(self):
+        self.failures = 0
+
+    def _on_component_changed(self, event: ChangeEvent):
+        if self.filename is None or self.stopped:
+            return
+        kind = event.kind
+        if kind == ChangeKind.SELECTION:
+            return
+        if kind == ChangeKind.MOVED:
+            self._geometry.update(dict.fromkeys(c for c in event.components if not isinstance(c, Arrow)))
+        elif kind == ChangeKind.RESTYLED:
+            self._colors.update(dict.fromkeys(event.components))
+        else:
+            # вставки и удаления ссылаются на номера строк, поэтому идут строго после накопленного
+            self.flush()
+            if kind == ChangeKind.INSERTED:
+                self._post({'op': 'insert', 'rows': event.rows, 'shapes': [c.freeze() for c in event.components]})
+            elif kind == ChangeKind.REMOVED:
+                self._post({'op': 'remove', 'rows': event.rows})
+            elif kind == ChangeKind.RELINKED:
+                arrows = event.components
+                self._post({'op': 'relink', 'ids': [a.id for a in arrows],
+                            'sources': [a.source.id if a.source else None for a in arrows],
+                            'targets': [a.target.id if a.target else None for a in arrows]})
+            return
+        if not self._timer.isActive():
+            self._timer.start()
+
+    @staticmethod
+    def _leaves(components, out: List['Shape']):
+        for c in components:
+            if isinstance(c, Shape):
+                out.append(c)
+            else:
+                Journal._leaves(c.get_children(), out)
+        return out
+
+    def flush(self):
+        """Отдаёт потоку накопленные сдвиги и перекраски или снимок документа."""
+        self._timer.stop()
+        if self.stopped:
+            return
+        if self._rebase:
+            # снимок уже содержит все накопленные изменения
+            self._rebase = False
+            self._geometry.clear()
+            self._colors.clear()
+            self._queue.put(('rebase', [c.freeze() for c in self.container.get_all()]))
+            return
+        if self._geometry:
+            leaves = self._leaves(self._geometry, [])
+            self._geometry.clear()
+            # удалённый после изменения лист держит строку уже в другом хранилище
+            self._post({'op': 'geometry', 'ids': [leaf.id for leaf in leaves],
+                        'values': [leaf.get_bounding_rect() for leaf in leaves]})
+        if self._colors:
+            arrows = [c for c in self._colors if isinstance(c, Arrow)]
+            leaves = self._leaves([c for c in self._colors if not isinstance(c, Arrow)], [])
+            self._colors.clear()
+            self._post({'op': 'color', 'ids': [c.id for c in leaves + arrows],
+                        'rgba': [leaf.store.colors[leaf._row] for leaf in leaves] +
+                                [a.color.rgba() for a in arrows]})
+
+    @staticmethod
+    def _encode(entry: Dict[str, Any]) -> Dict[str, Any]:
+        op = entry['op']
+        if op == 'geometry':
+            values = entry.pop('values')
+            columns = [list(column) for column in zip(*values)] or [[], [], [], []]
+            entry['x'], entry['y'], entry['w'], entry['h'] = columns
+        elif op == 'color':
+            entry['colors'] = ['#%06x' % (rgba & 0xFFFFFF) for rgba in entry.pop('rgba')]
+        elif op == 'insert':
+            entry['shapes'] = [Component.thaw(frozen) for frozen in entry['shapes']]
+        return entry
+
+    @staticmethod
+    def _json_default(value):
+        if isinstance(value, QColor):
+            return value.name()
+        raise TypeError(f"Не сериализуется: {type(value).__name__}")
+
+    def _run(self):
+        out = None
+        filename = None
+        # после ошибки записи журнал неполон: записи отбрасываются до нового снимка
+        broken = False
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            for item in batch:
+                try:
+                    if item[0] == 'entry':
+                        if broken:
+                            continue
+                        if out is None:
+                            out = open(self.paths(filename)[0], 'a', encoding='utf-8')
+                            if out.tell() == 0:
+                                out.write(json.dumps({'op': 'begin', 'id': str(uuid.uuid4())}) + '\n')
+                        out.write(json.dumps(self._encode(item[1]), default=self._json_default) + '\n')
+                    elif item[0] == 'rebase':
+                        out = self._close_quietly(out)
+                        self._checkpoint(filename, [Component.thaw(frozen) for frozen in item[1]], None)
+                        if broken:
+                            broken = False
+                            self.resumed.emit()
+                    elif item[0] == 'attach':
+                        _, new, reset, old = item
+                        out = self._close_quietly(out)
+                        filename = new
+                        broken = False
+                        if old is not None and old != new:
+                            self._remove(old)
+                        if reset:
+                            self._remove(new)
+                        elif self.has_recovery(new):
+                            self._compact(new)
+                    elif item[0] == 'close':
+                        self._close_quietly(out)
+                        if item[1] and filename is not None:
+                            self._remove(filename)
+                        return
+                except Exception as e:
+                    out = self._close_quietly(out)
+                    # неудачный снимок - тоже ошибка, по ней считаются повторы
+                    if not broken or item[0] != 'entry':
+                        broken = True
+                        self.failed.emit(f"{type(e).__name__}: {e}")
+            try:
+                if out is not None:
+                    out.flush()
+                    os.fsync(out.fileno())
+                    if out.tell() > self.COMPACT_BYTES:
+                        out.close()
+                        out = None
+                        self._compact(filename)
+            except Exception as e:
+                out = self._close_quietly(out)
+                if not broken:
+                    broken = True
+                    self.failed.emit(f"{type(e).__name__}: {e}")
+
+    @staticmethod
+    def _close_quietly(out) -> None:
+        """Закрывает файл журнала; ошибка закрытия уже ничего не меняет."""
+        if out is not None:
+            try:
+                out.close()
+            except OSError:
+                pass
+        return None
+
+    @classmethod
+    def _remove(cls, filename: str):
+        for path in cls.paths(filename):
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def _compact(cls, filename: str):
+        cls._checkpoint(filename, *cls._replayed(filename))
+
+    @classmethod
+    def _checkpoint(cls, filename: str, records: List[Dict[str, Any]], absorbed: Optional[str]):
+        """Пишет снимок записей верхнего уровня и удаляет журнал, который в нём учтён."""
+        journal, checkpoint = cls.paths(filename)
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': 1.1, 'journal': absorbed, 'shapes': records}, f, default=cls._json_default)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, checkpoint)
+        if os.path.exists(journal):
+            os.remove(journal)
+
+    @classmethod
+    def recover(cls, filename: str) -> List[Dict[str, Any]]:
+        """Записи верхнего уровня (формат save()) после снимка и журнала."""
+        return cls._replayed(filename)[0]
+
+    @classmethod
+    def _replayed(cls, filename: str):
+        journal, checkpoint = cls.paths(filename)
+        absorbed = None
+        if os.path.exists(checkpoint):
+            with open(checkpoint, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            records, absorbed = data['shapes'], data.get('journal')
+        elif not os.path.exists(filename):
+            records = []
+        else:
+            records = FiguresContainer.read_records(filename)
+        entries = []
+        if os.path.exists(journal):
+            with open(journal, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break  # недописанная при сбое последняя строка
+        if entries and entries[0].get('op') == 'begin' and entries[0]['id'] != absorbed:
+            cls.replay(records, entries[1:])
+            absorbed = entries[0]['id']
+        return records, absorbed
+
+    @staticmethod
+    def replay(records: List[Dict[str, Any]], entries: List[Dict[str, Any]]):
+        """Применяет записи журнала к списку записей верхнего уровня на месте."""
+        by_id: Dict[str, Dict[str, Any]] = {}
+
+        def register(data):
+            by_id[data['id']] = data
+            for child in data.get('children', ()):
+                register(child)
+
+        def unregister(data):
+            by_id.pop(data['id'], None)
+            for child in data.get('children', ()):
+                unregister(child)
+
+        for data in records:
+            register(data)
+        for entry in entries:
+            op = entry['op']
+            if op == 'insert':
+                for row, data in zip(entry['rows'], entry['shapes']):
+                    records.insert(row, data)
+                    register(data)
+            elif op == 'remove':
+                for row in entry['rows']:
+                    unregister(records.pop(row))
+            elif op == 'geometry':
+                for key, x, y, w, h in zip(entry['ids'], entry['x'], entry['y'], entry['w'], entry['h']):
+                    data = by_id.get(key)
+                    if data is not None:
+                        data['x'], data['y'], data['width'], data['height'] = x, y, w, h
+            elif op == 'color':
+                for key, color in zip(entry['ids'], entry['colors']):
+                    data = by_id.get(key)
+                    if data is not None:
+                        data['color'] = color
+            elif op == 'relink':
+                for key, source, target in zip(entry['ids'], entry['sources'], entry['targets']):
+                    data = by_id.get(key)
+                    if data is not None:
+                        data['source_id'], data['target_id'] = source, target
+
+
+class FileTask(QRunnable):
+    """Чтение или запись документа в пуле потоков.
+
+    work(progress) выполняется в рабочем потоке. progress(сделано, всего) шлёт
+    в поток GUI промилле готовности, а после cancel() прерывает работу
+    исключением Cancelled. Результат и ошибки приходят сигналами, stopped -
+    при любом завершении; до него на задачу нужно держать ссылку.
+    """
+
+    class Cancelled(Exception):
+        pass
+
+    class Signals(QObject):
+        progress = pyqtSignal(int)
+        finished = pyqtSignal(object)
+        failed = pyqtSignal(str)
+        stopped = pyqtSignal()
+
+    def __init__(self, work):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.work = work
+        self.signals = FileTask.Signals()
+        self._cancelled = threading.Event()
+        self._sent = -1
+        self.done = False
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def progress(self, done: int, total: int):
+        if self._cancelled.is_set():
+            raise FileTask.Cancelled()
+        value = 1000 * done // max(total, 1)
+        if value != self._sent:
+            self._sent = value
+            self.signals.progress.emit(value)
+
+    def run(self):
+        try:
+            result = self.work(self.progress)
+            if not self.cancelled:
+                self.signals.finished.emit(result)
+        except FileTask.Cancelled:
+            pass
+        except Exception as e:
+            self.signals.failed.emit(f"{type(e).__name__}: {e}")
+        finally:
+            self.done = True
+            self.signals.stopped.emit()
+
+
+class _TreeNode:
+    __slots__ = ('object', 'parent', 'row', 'children', 'stale_from')
+
+    def __init__(self, obj: Optional[Component], parent: Optional['_TreeNode'], row: int):
+        self.object = obj
+        self.parent = parent
+        self.row = row
+        self.children: List['_TreeNode'] = []
+        # после удаления строк номера row у детей начиная с этой позиции устарели
+        self.stale_from: Optional[int] = None
+
+
 class TreeViewModel(QAbstractItemModel):
+    FETCH_BATCH = 256
+    ITEM_FLAGS = Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable
+
     def __init__(self, container: FiguresContainer):
         super().__init__()
         self.container = container
         self.container.changed.connect(self._on_container_changed)
-        self.root_item = {"name": "Root", "object": None, "children": []}
-        self._build_tree()
+        self.container.component_changed.connect(self._on_component_changed)
+        self.root_item = _TreeNode(None, None, -1)
+        self._nodes: Dict[Component, _TreeNode] = {}
 
     def _on_container_changed(self):
         self.beginResetModel()
-        self._build_tree()
+        self.root_item.children = []
+        self.root_item.stale_from = None
+        self._nodes.clear()
         self.endResetModel()
 
-    def _build_tree(self):
-        self.root_item["children"].clear()
-        shapes = self.container.get_all()
-        for i, shape in enumerate(shapes):
-            self._add_node(shape, self.root_item, i + 1)
+    def _on_component_changed(self, event: ChangeEvent):
+        root = self.root_item
+        if event.kind == ChangeKind.REMOVED:
+            # строки за ещё не подгруженным хвостом в дереве не показаны
+            loaded = len(root.children)
+            for first, last in self._ranges([row for row in event.rows if row < loaded]):
+                self.beginRemoveRows(QModelIndex(), first, last)
+                for node in root.children[first:last + 1]:
+                    self._drop_node(node)
+                del root.children[first:last + 1]
+                if root.stale_from is None or first < root.stale_from:
+                    root.stale_from = first
+                self.endRemoveRows()
+        elif event.kind == ChangeKind.INSERTED:
+            for row, component in zip(event.rows, event.components):
+                # строки за ещё не подгруженным хвостом подтянет fetchMore
+                if row > len(root.children):
+                    break
+                self.beginInsertRows(QModelIndex(), row, row)
+                node = _TreeNode(component, root, row)
+                root.children.insert(row, node)
+                self._nodes[component] = node
+                if root.stale_from is None or row < root.stale_from:
+                    root.stale_from = row
+                self.endInsertRows()
+        elif event.kind == ChangeKind.SELECTION:
+            top_rows = []
+            for shape in event.components:
+                node = self._nodes.get(shape)
+                if node is None:
+                    continue
+                if node.parent is root:
+                    top_rows.append(self._row_of(node))
+                else:
+                    index = self.createIndex(self._row_of(node), 0, node)
+                    self.dataChanged.emit(index, index, [Qt.ItemDataRole.CheckStateRole])
+            if top_rows:
+                # одно событие на весь диапазон вместо сотен тысяч при выделении рамкой
+                self.dataChanged.emit(self.index(min(top_rows), 0), self.index(max(top_rows), 0),
+                                      [Qt.ItemDataRole.CheckStateRole])
 
-    def _add_node(self, shape, parent_node, index):
-        name = f"Объект {index} ({shape.get_type_name()})"
-        item = {"name": name, "object": shape, "children": [], "parent": parent_node}
-        parent_node["children"].append(item)
-        for j, child in enumerate(shape.get_children()):
-            self._add_node(child, item, j + 1)
+    @staticmethod
+    def _ranges(rows: List[int]) -> List[List[int]]:
+        """Строки по убыванию -> диапазоны [первая, последняя] подряд идущих, тоже по убыванию.
+
+        Удаление диапазонов в этом порядке не сдвигает ещё не удалённые.
+        """
+        ranges = []
+        for row in rows:
+            if ranges and ranges[-1][0] == row + 1:
+                ranges[-1][0] = row
+            else:
+                ranges.append([row, row])
+        return ranges
+
+    def _append_nodes(self, node: _TreeNode, components, parent_index: QModelIndex):
+        first = len(node.children)
+        self.beginInsertRows(parent_index, first, first + len(components) - 1)
+        for i, component in enumerate(components):
+            child = _TreeNode(component, node, first + i)
+            node.children.append(child)
+            self._nodes[component] = child
+        self.endInsertRows()
+
+    def _drop_node(self, node: _TreeNode):
+        self._nodes.pop(node.object, None)
+        for child in node.children:
+            self._drop_node(child)
+
+    def _row_of(self, node: _TreeNode) -> int:
+        parent = node.parent
+        if parent.stale_from is not None and node.row >= parent.stale_from:
+            for i in range(parent.stale_from, len(parent.children)):
+                parent.children[i].row = i
+            parent.stale_from = None
+        return node.row
+
+    def _node(self, index: QModelIndex) -> _TreeNode:
+        return index.internalPointer() if index.isValid() else self.root_item
+
+    def _source_count(self, node: _TreeNode) -> int:
+        if node is self.root_item:
+            return self.container.count()
+        return node.object.child_count()
+
+    def object_at(self, index: QModelIndex) -> Optional[Component]:
+        return self._node(index).object
+
+    def canFetchMore(self, parent=QModelIndex()):
+        node = self._node(parent)
+        return len(node.children) < self._source_count(node)
+
+    def fetchMore(self, parent=QModelIndex()):
+        node = self._node(parent)
+        start = len(node.children)
+        if node is self.root_item:
+            components = self.container.get_range(start, start + self.FETCH_BATCH)
+        else:
+            components = node.object.children_slice(start, start + self.FETCH_BATCH)
+        if components:
+            self._append_nodes(node, components, parent)
+
+    def hasChildren(self, parent=QModelIndex()):
+        node = self._node(parent)
+        return bool(node.children) or self._source_count(node) > 0
 
     def index(self, row, column, parent=QModelIndex()):
         if not self.hasIndex(row, column, parent): return QModelIndex()
-        parent_item = parent.internalPointer() if parent.isValid() else self.root_item
-        if row < len(parent_item["children"]):
-            return self.createIndex(row, column, parent_item["children"][row])
+        parent_item = self._node(parent)
+        if row < len(parent_item.children):
+            return self.createIndex(row, column, parent_item.children[row])
         return QModelIndex()
 
     def parent(self, index):
         if not index.isValid(): return QModelIndex()
-        child_item = index.internalPointer()
-        parent_item = child_item.get("parent")
+        parent_item = index.internalPointer().parent
         if parent_item is None or parent_item is self.root_item:
             return QModelIndex()
-        grandparent = parent_item.get("parent")
-        if grandparent:
-            row = grandparent["children"].index(parent_item)
-            return self.createIndex(row, 0, parent_item)
-        return QModelIndex()
+        return self.createIndex(self._row_of(parent_item), 0, parent_item)
 
     def rowCount(self, parent=QModelIndex()):
         if parent.column() > 0: return 0
-        parent_item = parent.internalPointer() if parent.isValid() else self.root_item
-        return len(parent_item["children"])
+        return len(self._node(parent).children)
 
     def columnCount(self, parent=QModelIndex()):
         return 1
 
     def data(self, index, role=Qt.ItemDataRole.DisplayRole):
         if not index.isValid(): return None
-        item = index.internalPointer()
+        obj = index.internalPointer().object
         if role == Qt.ItemDataRole.DisplayRole:
-            return item["name"]
+            return f"Объект {index.row() + 1} ({obj.get_type_name()})"
         elif role == Qt.ItemDataRole.CheckStateRole:
-            obj = item["object"]
             if obj is not None:
                 return Qt.CheckState.Checked if obj.is_selected else Qt.CheckState.Unchecked
         return None
 
     def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
         if role == Qt.ItemDataRole.CheckStateRole and index.isValid():
-            item = index.internalPointer()
-            obj = item["object"]
+            obj = index.internalPointer().object
             if obj is not None:
-                obj.is_selected = (value == Qt.CheckState.Checked.value)
-                self.dataChanged.emit(index, index, [Qt.ItemDataRole.CheckStateRole])
-                self.container.notify()
+                self.container.set_selected(obj, value == Qt.CheckState.Checked.value)
                 return True
         return False
 
     def flags(self, index):
         if not index.isValid(): return Qt.ItemFlag.NoItemFlags
-        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable
+        return self.ITEM_FLAGS
+
+
+class TileCache:
+    """Холст, нарезанный на плитки TILE x TILE, каждая отрисована в свой QPixmap.
+
+    Изменение не выбрасывает плитку, а копит в ней повреждённый прямоугольник;
+    при следующем показе перерисовывается только он. Плитки сверх budget байт
+    вытесняются в порядке давности показа (LRU).
+    """
+    TILE = 256
+
+    def __init__(self, budget: int = 64 * 1024 * 1024):
+        self.budget = budget
+        self._tiles: 'OrderedDict[Tuple[int, int], QPixmap]' = OrderedDict()
+        self._damage: Dict[Tuple[int, int], QRect] = {}
+        self._bytes = 0
+        self._ratio = 1.0
+
+    def keys(self, rect: QRect):
+        t = self.TILE
+        for row in range(rect.top() // t, rect.bottom() // t + 1):
+            for col in range(rect.left() // t, rect.right() // t + 1):
+                yield col, row
+
+    def invalidate(self, rect: QRect):
+        for key in self.keys(rect):
+            if key in self._tiles:
+                damaged = self._damage.get(key)
+                self._damage[key] = rect if damaged is None else damaged.united(rect)
+
+    def clear(self):
+        self._tiles.clear()
+        self._damage.clear()
+        self._bytes = 0
+
+    @property
+    def size(self) -> int:
+        """Память под плитками в байтах."""
+        return self._bytes
+
+    def tile(self, key: Tuple[int, int], ratio: float, render) -> QPixmap:
+        """Плитка key; недостающее дорисовывает render(painter, rect) в координатах холста."""
+        if ratio != self._ratio:
+            self.clear()
+            self._ratio = ratio
+        t = self.TILE
+        bounds = QRect(key[0] * t, key[1] * t, t, t)
+        pixmap = self._tiles.get(key)
+        if pixmap is None:
+            side = math.ceil(t * ratio)
+            pixmap = QPixmap(side, side)
+            pixmap.setDevicePixelRatio(ratio)
+            self._tiles[key] = pixmap
+            self._bytes += side * side * 4
+            self._evict()
+            damaged = bounds
+        else:
+            self._tiles.move_to_end(key)
+            damaged = self._damage.pop(key, None)
+            if damaged is None:
+                return pixmap
+            damaged = damaged.intersected(bounds)
+            if damaged.isEmpty():
+                return pixmap
+        painter = QPainter(pixmap)
+        painter.translate(-bounds.x(), -bounds.y())
+        painter.setClipRect(damaged)
+        render(painter, damaged)
+        painter.end()
+        return pixmap
+
+    def _evict(self):
+        # последняя плитка - только что созданная, её не трогаем
+        while self._bytes > self.budget and len(self._tiles) > 1:
+            key, pixmap = self._tiles.popitem(last=False)
+            self._damage.pop(key, None)
+            self._bytes -= pixmap.width() * pixmap.height() * 4
 
 
 class Form(QWidget):
+    # сколько прямоугольников перерисовки передавать по отдельности, дальше - одна общая рамка
+    MAX_DIRTY_RECTS = 64
+    # длина куска стрелки, на которые режется её область в слое перетаскивания
+    HOLE_STEP = 32
+
     def __init__(self, container: FiguresContainer):
         super().__init__()
         self.container = container
@@ -682,6 +3311,16 @@ class Form(QWidget):
         self.arrow_source = None
         self.last_mouse_pos = None
         self.dragging = False
+        self.band_origin = None
+        self.rubber_band = QRubberBand(QRubberBand.Shape.Rectangle, self)
+        self.tiles = TileCache()
+        # плитки нарисованы без сглаживания: сцена плотная по Component.detail
+        self.dense = False
+        # слой перетаскивания: сцена без перетаскиваемых компонентов, снятая в начале жеста
+        self.drag_layer: Optional[QPixmap] = None
+        self.drag_moving: List[Component] = []
+        self.drag_set: Set[Component] = set()
+        self.drag_holes: List[QRect] = []
         self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
         self.setMouseTracking(True)
         self.setStyleSheet("background-color: white;")
@@ -691,68 +3330,197 @@ class Form(QWidget):
         self.creating_arrow = (figure_type == 'arrow')
         self.arrow_source = None
 
+    def on_document_changed(self):
+        self.tiles.clear()
+        self.update()
+
+    def on_component_changed(self, event: ChangeEvent):
+        rects = event.rects
+        if self.drag_layer is not None:
+            if event.kind == ChangeKind.MOVED and self.drag_set.issuperset(event.components):
+                # плитки поправит _end_drag_layer; пока перерисовывается только слой
+                if rects is None:
+                    self.update()
+                for r in rects or ():
+                    self.update(r)
+                return
+            self._end_drag_layer()
+        if rects is None:
+            self.on_document_changed()
+            return
+        if len(rects) > self.MAX_DIRTY_RECTS:
+            bounds = rects[0]
+            for r in rects[1:]:
+                bounds = bounds.united(r)
+            rects = [bounds]
+        for r in rects:
+            self.tiles.invalidate(r)
+            self.update(r)
+
     def paintEvent(self, event):
         painter = QPainter(self)
-        painter.setRenderHint(QPainter.RenderHint.Antialiasing)
-        painter.fillRect(self.rect(), QColor("white"))  # Белый фон
-        for figure in self.container.get_all():
-            figure.draw(painter)
+        if self.drag_layer is not None:
+            # кадр перетаскивания: готовый фон плюс сами перетаскиваемые компоненты
+            rect = event.rect()
+            painter.drawPixmap(0, 0, self.drag_layer)
+            Component.detail.begin(painter, self.container.count(), self.width(), self.height())
+            batches = DrawBatches()
+            batches.add_all(f for f in self.drag_moving if rect.intersects(self._rect_of(f)))
+            batches.draw(painter)
+            return
+        # сглаживание решается по плотности всей сцены, иначе соседние плитки разошлись бы
+        dense = Component.detail.is_dense(self.container.count(), self.width(), self.height())
+        if dense != self.dense:
+            self.dense = dense
+            self.tiles.clear()
+        # холст собирается из плиток кэша; рисуются только повреждённые части плиток
+        self._draw_tiles(painter, event.rect())
+
+    def _draw_tiles(self, painter: QPainter, rect: QRect):
+        ratio = self.devicePixelRatioF()
+        t = TileCache.TILE
+        for key in self.tiles.keys(rect):
+            painter.drawPixmap(key[0] * t, key[1] * t, self.tiles.tile(key, ratio, self._render))
+
+    def _render(self, painter: QPainter, rect: QRect, skip: Set[Component] = frozenset(),
+                region: Optional[QRegion] = None):
+        painter.fillRect(rect, QColor("white"))  # Белый фон
+        Component.detail.begin(painter, self.container.count(), self.width(), self.height())
+        batches = DrawBatches()
+        for figure in self.container.get_in_rect(rect.x(), rect.y(), rect.width(), rect.height()):
+            if figure in skip or region is not None and not region.intersects(self._rect_of(figure)):
+                continue
+            batches.add(figure)
+        batches.draw(painter)
+
+    @staticmethod
+    def _rect_of(component: Component) -> QRect:
+        x, y, w, h = component.get_paint_rect()
+        return QRect(int(x) - 1, int(y) - 1, int(w) + 3, int(h) + 3)
+
+    def _holes_of(self, component: Component) -> List[QRect]:
+        """Где компонент рисует: рамка, а у стрелки - цепочка рамок вдоль линии.
+
+        Рамка длинной стрелки в плотной сцене накрывает тысячи фигур, а сама
+        стрелка - тонкая линия; куски по HOLE_STEP пикселей сужают перерисовку.
+        """
+        if not isinstance(component, Arrow) or not component.source or not component.target:
+            return [self._rect_of(component)]
+        x0, y0, x1, y1 = component.endpoints()
+        pieces = max(1, math.ceil(math.hypot(x1 - x0, y1 - y0) / self.HOLE_STEP))
+        # наконечник, перо и сглаживание
+        m = Arrow.HEAD_SIZE + 3
+        holes = []
+        for i in range(pieces):
+            ax, ay = x0 + (x1 - x0) * i / pieces, y0 + (y1 - y0) * i / pieces
+            bx, by = x0 + (x1 - x0) * (i + 1) / pieces, y0 + (y1 - y0) * (i + 1) / pieces
+            holes.append(QRect(int(min(ax, bx)) - m, int(min(ay, by)) - m,
+                               int(abs(bx - ax)) + 2 * m + 1, int(abs(by - ay)) + 2 * m + 1))
+        return holes
+
+    def _begin_drag_layer(self):
+        """Снимает фон для перетаскивания: плитки, где под выделением перерисовано без него.
+
+        Стоит один раз на жест и пропорционально площади выделения; дальше кадр -
+        копия фона и отрисовка только перетаскиваемых компонентов.
+        """
+        moving = self.container.dragged_with(self.container.get_selected())
+        if not moving:
+            return
+        ratio = self.devicePixelRatioF()
+        layer = QPixmap(math.ceil(self.width() * ratio), math.ceil(self.height() * ratio))
+        layer.setDevicePixelRatio(ratio)
+        painter = QPainter(layer)
+        self._draw_tiles(painter, self.rect())
+        self.drag_moving = moving
+        self.drag_set = set(moving)
+        self.drag_holes = [r for c in moving for r in self._holes_of(c)]
+        # дыры собираются в область по плиткам, чтобы каждое место перерисовывалось один раз
+        t = TileCache.TILE
+        parts: Dict[Tuple[int, int], QRegion] = {}
+        for r in self.drag_holes:
+            for key in self.tiles.keys(r):
+                part = QRegion(r.intersected(QRect(key[0] * t, key[1] * t, t, t)))
+                parts[key] = part.united(parts[key]) if key in parts else part
+        for region in parts.values():
+            painter.setClipRegion(region)
+            self._render(painter, region.boundingRect(), self.drag_set, region)
+        painter.end()
+        self.drag_layer = layer
+
+    def _end_drag_layer(self):
+        if self.drag_layer is None:
+            return
+        for r in self.drag_holes + [r for c in self.drag_moving for r in self._holes_of(c)]:
+            self.tiles.invalidate(r)
+        self.drag_layer = None
+        self.drag_moving, self.drag_set, self.drag_holes = [], set(), []
+        self.update()
 
     def mousePressEvent(self, event):
         if event.button() != Qt.MouseButton.LeftButton: return
         pos = event.pos()
         self.last_mouse_pos = pos
+        self.container.seal_history()
 
         if self.creating_arrow:
             clicked_object = self._find_object_at(pos)
             if clicked_object and not isinstance(clicked_object, Arrow):
                 if self.arrow_source is None:
                     self.arrow_source = clicked_object
-                    clicked_object.is_selected = True
+                    self.container.set_selected(clicked_object, True)
                 else:
                     if clicked_object != self.arrow_source:
                         arrow = Arrow(self.arrow_source, clicked_object)
                         self.container.add(arrow)
-                    self.arrow_source.is_selected = False
+                    self.container.set_selected(self.arrow_source, False)
                     self.arrow_source = None
-                self.container.notify()
             return
 #
         clicked_obj = self._find_object_at(pos)
         ctrl_pressed = event.modifiers() & Qt.KeyboardModifier.ControlModifier
         if not ctrl_pressed:
-            for shape in self.container.get_all():
-                shape.is_selected = False
+            self.container.set_selection(self.container.get_selected(), False)
         if clicked_obj:
-            clicked_obj.is_selected = not clicked_obj.is_selected if ctrl_pressed else True
+            self.container.set_selected(clicked_obj, not clicked_obj.is_selected if ctrl_pressed else True)
             self.dragging = True
         else:
             if self.figure_type and not self.creating_arrow:
                 new_shape = ShapeFactory.create_shape(self.figure_type, pos.x(), pos.y())
                 new_shape.is_selected = True
                 self.container.add(new_shape)
-        self.container.notify()
+            elif not self.figure_type:
+                self.band_origin = pos
+                self.rubber_band.setGeometry(QRect(pos, pos))
+                self.rubber_band.show()
 
     def _find_object_at(self, pos):
-        for shape in reversed(self.container.get_all()):
-            if shape.contains(pos):
-                return shape
-        return None
+        return self.container.topmost_at(pos)
 
     def mouseMoveEvent(self, event):
+        if self.band_origin is not None:
+            self.rubber_band.setGeometry(QRect(self.band_origin, event.pos()).normalized())
+            return
         if self.dragging and event.buttons() & Qt.MouseButton.LeftButton:
             if self.last_mouse_pos:
                 dx = event.pos().x() - self.last_mouse_pos.x()
                 dy = event.pos().y() - self.last_mouse_pos.y()
-                selected = self.container.get_selected()
-                for shape in selected:
-                    shape.move(dx, dy, self.width(), self.height())
+                if self.drag_layer is None:
+                    self._begin_drag_layer()
+                self.container.move_many(self.container.get_selected(), dx, dy, self.width(), self.height())
                 self.last_mouse_pos = event.pos()
-                self.container.notify()
 
     def mouseReleaseEvent(self, event):
         if event.button() == Qt.MouseButton.LeftButton:
             self.dragging = False
+            self._end_drag_layer()
+            self.container.seal_history()
+            if self.band_origin is not None:
+                r = self.rubber_band.geometry()
+                self.rubber_band.hide()
+                self.band_origin = None
+                self.container.set_selection(
+                    self.container.components_in_rect(r.x(), r.y(), r.width(), r.height()), True)
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_Delete:
@@ -765,37 +3533,51 @@ class Form(QWidget):
             elif event.key() == Qt.Key.Key_Up: dy = -step
             elif event.key() == Qt.Key.Key_Down: dy = step
             selected = self.container.get_selected()
-            for shape in selected:
-                if event.modifiers() & Qt.KeyboardModifier.ShiftModifier:
-                    shape.resize_shape(dx, dy, self.width(), self.height())
-                else:
-                    shape.move(dx, dy, self.width(), self.height())
-            self.container.notify()
+            if event.modifiers() & Qt.KeyboardModifier.ShiftModifier:
+                self.container.resize_many(selected, dx, dy, self.width(), self.height())
+            else:
+                self.container.move_many(selected, dx, dy, self.width(), self.height())
         elif event.key() == Qt.Key.Key_G and event.modifiers() & Qt.KeyboardModifier.ControlModifier:
             self.container.group_selected()
         elif event.key() == Qt.Key.Key_U and event.modifiers() & Qt.KeyboardModifier.ControlModifier:
             self.container.ungroup_selected()
+        elif event.key() == Qt.Key.Key_Z and event.modifiers() & Qt.KeyboardModifier.ControlModifier:
+            if event.modifiers() & Qt.KeyboardModifier.ShiftModifier:
+                self.container.redo()
+            else:
+                self.container.undo()
+        elif event.key() == Qt.Key.Key_Y and event.modifiers() & Qt.KeyboardModifier.ControlModifier:
+            self.container.redo()
+
+    def keyReleaseEvent(self, event):
+        # удержанная стрелка - один шаг отмены, как перетаскивание; у автоповтора
+        # release приходит на каждый повтор, такие жест не закрывают
+        if event.key() in (Qt.Key.Key_Left, Qt.Key.Key_Right, Qt.Key.Key_Up, Qt.Key.Key_Down) \
+                and not event.isAutoRepeat():
+            self.container.seal_history()
 
     def change_selected_color(self, color):
-        for shape in self.container.get_selected():
-            shape.set_color(color)
-        self.container.notify()
+        self.container.restyle(self.container.get_selected(), color)
 
 
 class Okno(QMainWindow):
+    FILE_FILTERS = "Text Files (*.txt);;Binary Files (*.figb);;Segmented Files (*.figs)"
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("mainWindow")
         self.resize(1200, 800)
         self.container = FiguresContainer()
         self.form = Form(self.container)
-        self.container.changed.connect(self.form.update)
+        self.container.changed.connect(self.form.on_document_changed)
+        self.container.component_changed.connect(self.form.on_component_changed)
 
         self.tree_view = QTreeView()
         self.tree_view.setStyleSheet("background-color: white; color: black;")
         self.model = TreeViewModel(self.container)
         self.tree_view.setModel(self.model)
         self.tree_view.setHeaderHidden(True)
+        self.tree_view.setUniformRowHeights(True)
         self.tree_view.clicked.connect(self.on_tree_item_clicked)
 
         splitter = QSplitter(Qt.Orientation.Horizontal)
@@ -805,11 +3587,97 @@ class Okno(QMainWindow):
         self.setCentralWidget(splitter)
 
         self.toolbar()
+        self.task: Optional[FileTask] = None
+        self.tasks: Set[FileTask] = set()
+        self.progress: Optional[QProgressDialog] = None
+
+        # у ещё не сохранённого документа журнал живёт в каталоге данных приложения
+        data_dir = QStandardPaths.writableLocation(QStandardPaths.StandardLocation.AppDataLocation)
+        os.makedirs(data_dir, exist_ok=True)
+        self.untitled = os.path.join(data_dir, 'untitled.txt')
+        self.journal = Journal(self.container)
+        self.journal.failed.connect(self.journal_failed)
+        self.journal.resumed.connect(lambda: self.statusBar().showMessage("Журнал правок снова пишется", 5000))
+        recovered = Journal.has_recovery(self.untitled) and self.ask_recover() and self.container.recover(self.untitled)
+        self.journal.attach(self.untitled, reset=not recovered)
+
+    def ask_recover(self) -> bool:
+        answer = QMessageBox.question(self, "Восстановление",
+                                      "После сбоя остались несохранённые изменения. Восстановить?")
+        return answer == QMessageBox.StandardButton.Yes
+
+    def journal_failed(self, message: str):
+        if self.journal.stopped:
+            self.statusBar().showMessage("Журнал правок остановлен: " + message)
+            self.show_error("Журнал правок не удаётся записать, восстановление после сбоя недоступно "
+                            "до следующего сохранения или открытия документа.\n" + message)
+        else:
+            self.statusBar().showMessage(f"Ошибка журнала правок, повтор через {Journal.RETRY_MS // 1000} с: "
+                                         + message)
+
+    def closeEvent(self, event):
+        for task in self.tasks:
+            task.cancel()
+        # обычный выход: несохранённые изменения отбрасываются, как и раньше
+        self.journal.close(discard=True)
+        super().closeEvent(event)
+
+    def run_task(self, label: str, work, on_done, span: int = 1000):
+        """Запускает FileTask под окном прогресса с кнопкой отмены.
+
+        Окно модальное, так что документ не меняется, пока рабочий поток его читает.
+        Прогресс задачи занимает первые span промилле шкалы; on_done(результат)
+        вызывается в потоке GUI, если задачу не отменили.
+        """
+        self.show_progress(label)
+        self.task = FileTask(work)
+        self.tasks.add(self.task)
+        self.task_span = span
+        self.task_done = on_done
+        self.progress.canceled.connect(self.task.cancel)
+        self.task.signals.progress.connect(self._task_progress)
+        self.task.signals.finished.connect(self._task_finished)
+        self.task.signals.failed.connect(self._task_failed)
+        self.task.signals.stopped.connect(self._task_stopped)
+        QThreadPool.globalInstance().start(self.task)
+
+    def show_progress(self, label: str):
+        if self.progress is not None:
+            self.progress.deleteLater()
+        self.progress = QProgressDialog(label, "Отмена", 0, 1000, self)
+        self.progress.setWindowModality(Qt.WindowModality.WindowModal)
+        self.progress.setMinimumDuration(0)
+        self.progress.setAutoClose(False)
+        self.progress.show()
+
+    def _is_current(self) -> bool:
+        # отменённая задача может дорабатывать, пока идёт следующая; её сигналы не нужны
+        return self.sender() is self.task.signals and not self.task.cancelled
+
+    def _task_progress(self, value: int):
+        if self._is_current():
+            self.progress.setValue(value * self.task_span // 1000)
+
+    def _task_finished(self, result):
+        if self._is_current():
+            self.task_done(result)
+
+    def _task_failed(self, message: str):
+        if self._is_current():
+            self.progress.close()
+            self.show_error(message)
+
+    def _task_stopped(self):
+        self.tasks = {task for task in self.tasks if not task.done}
+
+    def show_error(self, message: str):
+        QMessageBox.warning(self, "Ошибка", message)
 
     def toolbar(self):
         tb = QToolBar()
         self.addToolBar(tb)
 
+        tb.addAction("Выделение", lambda: self.form.set_figure_type(None))
         tb.addAction("Круг", lambda: self.form.set_figure_type('circle'))
         tb.addAction("Прямоугольник", lambda: self.form.set_figure_type('rectangle'))
         tb.addAction("Треугольник", lambda: self.form.set_figure_type('triangle'))
@@ -817,6 +3685,8 @@ class Okno(QMainWindow):
         tb.addAction("Стрелка", lambda: self.form.set_figure_type('arrow'))
         tb.addAction("Группировать", self.container.group_selected)
         tb.addAction("Разгруппировать", self.container.ungroup_selected)
+        tb.addAction("Отменить", self.container.undo)
+        tb.addAction("Повторить", self.container.redo)
         tb.addAction("Изменить цвет", self.change_color)
         tb.addAction("Сохранить", self.save_project)
         tb.addAction("Загрузить", self.load_project)
@@ -827,25 +3697,76 @@ class Okno(QMainWindow):
             self.form.change_selected_color(col)
 
     def save_project(self):
-        fname, _ = QFileDialog.getSaveFileName(self, "Сохранить", "", "Text Files (*.txt)")
-        if fname:
-            self.container.save_to_file(fname)
+        fname, selected_filter = QFileDialog.getSaveFileName(self, "Сохранить", "", self.FILE_FILTERS)
+        if not fname:
+            return
+        layout = FiguresContainer.LAYOUTS.get(os.path.splitext(fname)[1].lower(), 'json')
+        if selected_filter.startswith("Binary"):
+            layout = 'binary'
+        elif selected_filter.startswith("Segmented"):
+            layout = 'segmented'
+        components = self.container.get_all()
+        self.container.detach_document()
+        # рамки групп и id считаются здесь: paintEvent читает их, пока пишет рабочий поток
+        for c in components:
+            c.settle()
+
+        def saved(_):
+            self.progress.close()
+            self.journal.attach(fname)
+
+        self.run_task("Сохранение...", lambda progress: FiguresContainer.write_file(
+            fname, components, layout, progress), saved)
 
     def load_project(self):
-        fname, _ = QFileDialog.getOpenFileName(self, "Загрузить", "", "Text Files (*.txt)")
-        if fname:
-            self.container.load_from_file(fname)
+        fname, _ = QFileDialog.getOpenFileName(self, "Загрузить", "", self.FILE_FILTERS + ";;All Files (*)")
+        if not fname:
+            return
+        if Journal.has_recovery(fname) and self.ask_recover():
+            self.run_task("Восстановление...", lambda progress: Journal.recover(fname),
+                          lambda records: self.build_loaded(records, fname, False), 500)
+        elif self.container.open_mapped(fname):
+            self.journal.attach(fname)
+        elif BinaryDocument.is_binary(fname):
+            # двоичный поток разбирается прямо в сборку, без списка всех записей
+            self.show_progress("Загрузка...")
+            self.build_steps(self.container.load_binary_steps(fname), fname, True, 0)
+        else:
+            self.run_task("Загрузка...", lambda progress: FiguresContainer.read_records(fname, progress),
+                          lambda records: self.build_loaded(records, fname, True), 500)
+
+    def build_loaded(self, records, fname: str, reset: bool):
+        """Вторая половина загрузки: сборка компонентов в потоке GUI по частям между событиями."""
+        self.build_steps(self.container.load_steps(records), fname, reset, 500)
+
+    def build_steps(self, steps, fname: str, reset: bool, start: int):
+        """Прогоняет шаги load_steps между событиями; шкала прогресса - от start промилле до конца."""
+        def step():
+            if self.progress.wasCanceled():
+                steps.close()
+                return
+            try:
+                fraction = next(steps)
+            except StopIteration:
+                self.progress.close()
+                self.journal.attach(fname, reset=reset)
+                return
+            except Exception as e:
+                self.progress.close()
+                self.show_error(f"{type(e).__name__}: {e}")
+                return
+            self.progress.setValue(start + int((1000 - start) * fraction))
+            QTimer.singleShot(0, step)
+
+        step()
 
     def on_tree_item_clicked(self, index):
-        item = index.internalPointer()
-        shape = item.get("object")
+        shape = self.model.object_at(index)
         if shape:
             ctrl = QApplication.keyboardModifiers() & Qt.KeyboardModifier.ControlModifier
             if not ctrl:
-                for s in self.container.get_all():
-                    s.is_selected = False
-            shape.is_selected = not shape.is_selected
-            self.container.notify()
+                self.container.set_selection(self.container.get_selected(), False)
+            self.container.set_selected(shape, not shape.is_selected)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,118 @@
+"""Отрисовка сохранённых документов в PNG без окна.
+
+Каждый файл загружается FiguresContainer.load_from_file и рисуется методами
+draw() компонентов в QImage на платформе offscreen, как его показала бы Form
+(начало координат холста в углу картинки). Файлы раздаются пулу процессов;
+для каждого печатается число компонентов и время загрузки, отрисовки и записи.
+Картинка больше --max-size по длинной стороне уменьшается целиком.
+
+Мелкие после уменьшения фигуры и стрелки рисуются упрощённо, плотные кадры -
+без сглаживания (main.LevelOfDetail, пороги --min-shape, --min-arrow, --dense);
+--no-lod рисует всё полностью, так выигрыш виден по столбцу paint s.
+
+    python render.py a.figb b.txt c.figs -o png --jobs 4
+"""
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt6.QtGui import QGuiApplication, QImage, QPainter, QColor
+
+import main
+
+_app = None
+
+
+def init_worker():
+    global _app
+    _app = QGuiApplication.instance() or QGuiApplication(['render'])
+
+
+def render(filename, output, margin, max_size, detail=()):
+    """(файл, png, компонентов, загрузка, отрисовка, запись, ошибка) - секунды, ошибка или None.
+
+    detail - пороги main.LevelOfDetail; нули рисуют всё полностью.
+    """
+    main.Component.detail = main.LevelOfDetail(*detail)
+    start = time.perf_counter()
+    container = main.FiguresContainer()
+    if not container.load_from_file(filename):
+        return filename, None, 0, time.perf_counter() - start, 0, 0, "не удалось загрузить"
+    components = container.get_all()
+    loaded = time.perf_counter()
+
+    right = bottom = 0
+    for c in components:
+        x, y, w, h = c.get_paint_rect()
+        right = max(right, x + w)
+        bottom = max(bottom, y + h)
+    width, height = math.ceil(right) + margin, math.ceil(bottom) + margin
+    scale = min(1.0, max_size / max(width, height))
+    image = QImage(max(1, int(width * scale)), max(1, int(height * scale)),
+                   QImage.Format.Format_ARGB32_Premultiplied)
+    image.fill(QColor("white"))
+    painter = QPainter(image)
+    painter.scale(scale, scale)
+    main.Component.detail.begin(painter, len(components), width, height)
+    batches = main.DrawBatches()
+    batches.add_all(components)
+    batches.draw(painter)
+    painter.end()
+    painted = time.perf_counter()
+
+    png = os.path.join(output, os.path.splitext(os.path.basename(filename))[0] + '.png')
+    if not image.save(png):
+        return filename, None, len(components), loaded - start, painted - loaded, 0, "не удалось записать PNG"
+    return filename, png, len(components), loaded - start, painted - loaded, time.perf_counter() - painted, None
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-o', '--output', default='.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--margin', type=int, default=20)
+    parser.add_argument('--max-size', type=int, default=16384)
+    lod = main.LevelOfDetail()
+    parser.add_argument('--min-shape', type=float, default=lod.min_shape)
+    parser.add_argument('--min-arrow', type=float, default=lod.min_arrow)
+    parser.add_argument('--dense', type=float, default=lod.dense)
+    parser.add_argument('--no-lod', action='store_true')
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+
+    start = time.perf_counter()
+    detail = (0, 0, 0) if args.no_lod else (args.min_shape, args.min_arrow, args.dense)
+    jobs = [(f, args.output, args.margin, args.max_size, detail) for f in args.files]
+    if args.jobs == 1:
+        init_worker()
+        results = (render(*job) for job in jobs)
+        pool = None
+    else:
+        # spawn: у каждого процесса своё QGuiApplication и свой ShapeStore
+        pool = ProcessPoolExecutor(args.jobs, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=init_worker)
+        results = (future.result() for future in as_completed([pool.submit(render, *job) for job in jobs]))
+
+    failed = 0
+    print(f"{'file':<40}{'shapes':>9}{'load s':>9}{'paint s':>9}{'write s':>9}")
+    try:
+        for filename, png, count, load_s, paint_s, write_s, error in results:
+            print(f"{filename:<40}{count:>9}{load_s:>9.3f}{paint_s:>9.3f}{write_s:>9.3f}"
+                  + (f"  {error}" if error else ""))
+            failed += error is not None
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f"{len(jobs)} files, {failed} failed, {time.perf_counter() - start:.3f} s")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
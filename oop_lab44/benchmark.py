@@ -0,0 +1,174 @@
+"""Замеры кадра холста: время и число Qt-объектов на кадр.
+
+Кадр - полная перерисовка сцены Canvas.render_tile в QImage и серия
+проверок попадания ShapeStorage.hit. Считаются объекты геометрии и стиля,
+которые создаёт main.py: конструкторы QRect, QPoint, QPolygon, QLine, QPen,
+QBrush и т.п. плюс методы Qt, возвращающие новый объект (adjusted,
+boundingRect, center...). Кэши геометрии заполняются уже при добавлении
+фигуры (ShapeStorage.validate), поэтому первый кадр не дороже следующих.
+
+Столбцы uncached - тот же кадр, когда перед каждым кадром кэши всех фигур
+сброшены (Shape.invalidate): так фигуры строят геометрию заново каждый раз,
+как до кэширования, и оба числа воспроизводятся одним запуском.
+
+С --tiles замеряется перерисовка одной плитки TileCache при росте числа фигур
+и постоянной плотности (холст растёт вместе со сценой): фигуры плитки берутся
+из сетки ShapeStorage, поэтому время не должно расти с размером сцены.
+Столбец scan - для сравнения, линейный отбор тех же фигур по всему хранилищу.
+
+    python benchmark.py --shapes 10000 --frames 5
+    python benchmark.py --tiles --tile-shapes 10000,40000,160000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PyQt6.QtCore import QPoint, QRect
+from PyQt6.QtGui import QImage
+from PyQt6.QtWidgets import QApplication
+
+import main
+
+# конструкторы из пространства имён main.py
+CONSTRUCTORS = ('QRect', 'QPoint', 'QPointF', 'QPolygon', 'QLine', 'QLineF', 'QPen', 'QBrush', 'QColor')
+# методы значений Qt, которые возвращают новый объект
+RETURNS_NEW = {'adjusted', 'translated', 'normalized', 'united', 'intersected', 'boundingRect',
+               'center', 'topLeft', 'topRight', 'bottomLeft', 'bottomRight'}
+
+
+class Allocations:
+    def __init__(self):
+        self.count = 0
+        self._saved = {}
+
+    def __enter__(self):
+        for name in CONSTRUCTORS:
+            if hasattr(main, name):
+                self._saved[name] = cls = getattr(main, name)
+                setattr(main, name, self._counting(cls))
+        sys.setprofile(self._profile)
+        return self
+
+    def __exit__(self, *exc):
+        sys.setprofile(None)
+        for name, cls in self._saved.items():
+            setattr(main, name, cls)
+
+    def _counting(self, cls):
+        def make(*args):
+            self.count += 1
+            return cls(*args)
+        return make
+
+    def _profile(self, frame, event, arg):
+        if event == 'c_call' and arg.__name__ in RETURNS_NEW:
+            self.count += 1
+
+
+def make_scene(canvas, n, selected):
+    random.seed(0)
+    w, h = canvas.width(), canvas.height()
+    for _ in range(n):
+        x, y = random.randint(80, w - 80), random.randint(80, h - 80)
+        kind = random.randrange(4)
+        if kind == 0:
+            shape = main.Circle(QPoint(x, y), random.randint(10, 50))
+        elif kind == 1:
+            shape = main.Rectangle(x - 40, y - 30, random.randint(20, 80), random.randint(20, 60))
+        elif kind == 2:
+            shape = main.Triangle(QPoint(x, y), random.randint(15, 50))
+        else:
+            shape = main.LineSegment(QPoint(x - 50, y), QPoint(x + 50, y + random.randint(-30, 30)))
+        canvas.storage.add(shape)
+    for shape in random.sample(list(canvas.storage), int(n * selected)):
+        canvas.select_shape(shape)
+
+
+def frame(canvas, image, points):
+    p = main.QPainter(image)
+    canvas.render_tile(p, QRect(0, 0, canvas.width(), canvas.height()))
+    p.end()
+    for point in points:
+        canvas.storage.hit(point)
+
+
+def tile_cost(n, repeats):
+    # плотность как у сцены по умолчанию: 10000 фигур на 1600x1000
+    canvas = main.Canvas()
+    canvas.resize(1600, max(1000, n // 10))
+    make_scene(canvas, n, 0)
+    t = main.TileCache.TILE
+    rect = QRect(2 * t, t, t, t)
+    image = QImage(t, t, QImage.Format.Format_ARGB32_Premultiplied)
+    # первый проход заполняет кэши геометрии и не считается
+    start = time.perf_counter()
+    for i in range(repeats + 1):
+        if i == 1:
+            start = time.perf_counter()
+        p = main.QPainter(image)
+        p.translate(-rect.x(), -rect.y())
+        canvas.render_tile(p, rect)
+        p.end()
+    tile = (time.perf_counter() - start) * 1000 / repeats
+    start = time.perf_counter()
+    for _ in range(repeats):
+        inside = [s for s in canvas.storage if rect.intersects(canvas.area(s))]
+    scan = (time.perf_counter() - start) * 1000 / repeats
+    return len(inside), tile, scan
+
+
+def measure(args, counted, cached=True):
+    # своя сцена на каждый проход, чтобы первый кадр всегда шёл с пустыми кэшами
+    canvas = main.Canvas()
+    canvas.resize(1600, 1000)
+    make_scene(canvas, args.shapes, args.selected)
+    image = QImage(canvas.size(), QImage.Format.Format_ARGB32_Premultiplied)
+    points = [QPoint(random.randrange(canvas.width()), random.randrange(canvas.height())) for _ in range(args.hits)]
+    results = []
+    for _ in range(args.frames):
+        if not cached:
+            for shape in canvas.storage:
+                shape.invalidate()
+        if counted:
+            with Allocations() as allocations:
+                frame(canvas, image, points)
+            results.append(allocations.count)
+        else:
+            start = time.perf_counter()
+            frame(canvas, image, points)
+            results.append((time.perf_counter() - start) * 1000)
+    return results
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shapes', type=int, default=10000)
+    parser.add_argument('--frames', type=int, default=5)
+    parser.add_argument('--hits', type=int, default=100)
+    parser.add_argument('--selected', type=float, default=0.1)
+    parser.add_argument('--tiles', action='store_true')
+    parser.add_argument('--tile-shapes', default='10000,20000,40000,80000')
+    args = parser.parse_args()
+    app = QApplication.instance() or QApplication(['benchmark'])
+    if args.tiles:
+        print(f"{'shapes':<10}{'in tile':>10}{'tile ms':>10}{'scan ms':>10}")
+        for n in map(int, args.tile_shapes.split(',')):
+            inside, tile, scan = tile_cost(n, args.frames)
+            print(f"{n:<10}{inside:>10}{tile:>10.1f}{scan:>10.1f}")
+        return 0
+    columns = [measure(args, counted, cached) for cached in (True, False) for counted in (False, True)]
+    print(f"{'':<8}{'cached':>34}{'uncached':>34}")
+    print(f"{'frame':<8}" + f"{'ms':>10}{'objects':>12}{'per shape':>12}" * 2)
+    for i, (ms, count, base_ms, base_count) in enumerate(zip(*columns)):
+        label = 'first' if i == 0 else str(i)
+        print(f"{label:<8}{ms:>10.1f}{count:>12}{count / args.shapes:>12.1f}"
+              f"{base_ms:>10.1f}{base_count:>12}{base_count / args.shapes:>12.1f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(run())
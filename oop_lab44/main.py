@@ -1,34 +1,324 @@
 import sys
+import math
+from collections import Counter, OrderedDict, deque
+from itertools import chain
 from PyQt6.QtWidgets import *
 from PyQt6.QtGui import *
-from PyQt6.QtCore import Qt, QPoint, QRect, QPointF, QLineF
+from PyQt6.QtCore import Qt, QPoint, QRect, QPointF, QLine, pyqtSignal
+
+class GridIndex:
+    CELL = 64
+
+    def __init__(self, order=None):
+        # order(ключ) - z-порядок; ячейки держатся отсортированными для поиска сверху вниз
+        self.order = order
+        self.rects = {}
+        # ячейка -> {ключ: рамка}, рамка [left, top, right, bottom] включительно
+        self.cells = {}
+        self.unsorted = set()
+
+    def span(self, rect):
+        c = self.CELL
+        return range(rect[1] // c, rect[3] // c + 1), range(rect[0] // c, rect[2] // c + 1)
+
+    def insert(self, key, rect):
+        old = self.rects.get(key)
+        if old is not None:
+            # рамка общая для всех её ячеек: в пределах тех же ячеек правится на месте
+            if self.span(old) == self.span(rect):
+                old[:] = rect
+                return
+            self.remove(key)
+        rect = self.rects[key] = list(rect)
+        rows, cols = self.span(rect)
+        cells, order = self.cells, self.order
+        for row in rows:
+            for col in cols:
+                bucket = cells.get((col, row))
+                if bucket is None:
+                    bucket = cells[col, row] = {}
+                elif order is not None and order(next(reversed(bucket))) > order(key):
+                    self.unsorted.add((col, row))
+                bucket[key] = rect
+
+    def remove(self, key):
+        rect = self.rects.pop(key, None)
+        if rect is None:
+            return
+        rows, cols = self.span(rect)
+        cells = self.cells
+        for row in rows:
+            for col in cols:
+                bucket = cells[col, row]
+                del bucket[key]
+                if not bucket:
+                    del cells[col, row]
+                    self.unsorted.discard((col, row))
+
+    def reorder(self, key):
+        rect = self.rects.get(key)
+        if rect is not None:
+            rows, cols = self.span(rect)
+            self.unsorted.update((col, row) for row in rows for col in cols)
+
+    def clear(self):
+        self.rects.clear()
+        self.cells.clear()
+        self.unsorted.clear()
+
+    def at(self, x, y):
+        c = self.CELL
+        bucket = self.cells.get((x // c, y // c), {})
+        return [k for k, (l, t, r, b) in bucket.items() if l <= x <= r and t <= y <= b]
+
+    def query(self, rect):
+        # ключи, чьи рамки пересекают rect [left, top, right, bottom]
+        l, t, r, b = rect
+        rows, cols = self.span(rect)
+        cells = self.cells
+        if len(rows) * len(cols) > len(cells):
+            buckets = [bucket for (col, row), bucket in cells.items() if col in cols and row in rows]
+        else:
+            buckets = [cells[col, row] for row in rows for col in cols if (col, row) in cells]
+        found = {}
+        for bucket in buckets:
+            for k, (kl, kt, kr, kb) in bucket.items():
+                if kl <= r and l <= kr and kt <= b and t <= kb:
+                    found[k] = None
+        return found
+
+    def top(self, x, y, accept):
+        # первый сверху ключ, чья рамка содержит точку и который принят accept
+        c = self.CELL
+        cell = x // c, y // c
+        bucket = self.cells.get(cell)
+        if bucket is None:
+            return None
+        if cell in self.unsorted:
+            self.unsorted.discard(cell)
+            order = self.order
+            bucket = self.cells[cell] = dict(sorted(bucket.items(), key=lambda item: order(item[0])))
+        for k, (l, t, r, b) in reversed(bucket.items()):
+            if l <= x <= r and t <= y <= b and accept(k):
+                return k
+        return None
+
 
 class ShapeStorage:
+    # всё, что циклы отрисовки, hit-теста и перетаскивания вызывают у фигуры без проверок
+    PROTOCOL = ('pen', 'draw_batch', 'batch_item', 'bounding_rect', 'paint_rect', 'handle_rects',
+                'contains', 'move_by', 'resize', 'invalidate')
+
     def __init__(self):
-        self._items = []
+        # порядок отрисовки: _back от последней отправленной назад, затем _front по порядку
+        self._front = {}
+        self._back = {}
+        self._z = {}
+        self._top = 0
+        self._bottom = 0
+        # рамки всех фигур и ручки только выделенных
+        self.index = GridIndex(self._z.__getitem__)
+        self.handles = GridIndex()
+        self._handle_count = {}
+        # отклонённые при добавлении фигуры: счётчик по классу фигуры и последние причины
+        self.failures = Counter()
+        self.rejected = deque(maxlen=32)
+        self.on_failure = None
+
+    def validate(self, shape):
+        for name in self.PROTOCOL:
+            if not callable(getattr(shape, name, None)):
+                return f"нет метода {name}"
+        color = getattr(shape, 'color', None)
+        if not isinstance(color, QColor) or not color.isValid():
+            return "неверный цвет"
+        try:
+            shape.invalidate()
+            rects = [shape.bounding_rect(), shape.paint_rect(), *shape.handle_rects()]
+            item = shape.batch_item()
+        except Exception as e:
+            return f"{type(e).__name__}: {e}"
+        if not all(isinstance(r, QRect) for r in rects):
+            return "рамка не QRect"
+        if item is None:
+            return "нет элемента для отрисовки"
+        return None
 
     def add(self, shape):
-        self._items.append(shape)
+        if shape in self._z:
+            return True
+        error = self.validate(shape)
+        if error is not None:
+            self.fail(type(shape).__name__, error, shape)
+            return False
+        self._front[shape] = None
+        self._z[shape] = self._top
+        self._top += 1
+        shape.storage = self
+        self.changed(shape)
+        return True
+
+    def fail(self, source, error, shape=None):
+        self.failures[source] += 1
+        self.rejected.append((source, error, shape))
+        if self.on_failure is not None:
+            self.on_failure(source, error)
 
     def remove(self, shape):
-        if shape in self._items:
-            self._items.remove(shape)
+        if self.unlink(shape) is None:
+            return
+        shape.storage = None
+        self.index.remove(shape)
+        self.drop_handles(shape)
+
+    def unlink(self, shape):
+        z = self._z.pop(shape, None)
+        if z is not None:
+            del (self._front if z >= 0 else self._back)[shape]
+        return z
+
+    def bring_to_front(self, shapes):
+        for s in sorted((s for s in shapes if s in self._z), key=self._z.__getitem__):
+            self.unlink(s)
+            self._front[s] = None
+            self._z[s] = self._top
+            self._top += 1
+            self.index.reorder(s)
+
+    def send_to_back(self, shapes):
+        for s in sorted((s for s in shapes if s in self._z), key=self._z.__getitem__, reverse=True):
+            self.unlink(s)
+            self._bottom -= 1
+            self._back[s] = None
+            self._z[s] = self._bottom
+            self.index.reorder(s)
 
     def clear(self):
-        self._items.clear()
+        for s in self._z:
+            s.storage = None
+        self._front.clear()
+        self._back.clear()
+        self._z.clear()
+        self._top = self._bottom = 0
+        self.index.clear()
+        self.handles.clear()
+        self._handle_count.clear()
+
+    def changed(self, shape):
+        r = shape.bounding_rect()
+        self.index.insert(shape, (r.left(), r.top(), r.right(), r.bottom()))
+        self.drop_handles(shape)
+        if shape.selected:
+            rects = shape.handle_rects()
+            for i, h in enumerate(rects):
+                self.handles.insert((shape, i), (h.left(), h.top(), h.right(), h.bottom()))
+            self._handle_count[shape] = len(rects)
+
+    def drop_handles(self, shape):
+        for i in range(self._handle_count.pop(shape, 0)):
+            self.handles.remove((shape, i))
+
+    def hit(self, pos):
+        # верхняя фигура под точкой; ручка выделенной фигуры важнее её самой
+        x, y = pos.x(), pos.y()
+        z = self._z
+        hit, handle, top = None, None, -math.inf
+        for s, i in self.handles.at(x, y):
+            if z[s] > top or z[s] == top and i < handle:
+                hit, handle, top = s, i, z[s]
+        s = self.index.top(x, y, lambda s: z[s] <= top or s.contains(pos))
+        if s is not None and z[s] > top:
+            return s, None
+        return hit, handle
+
+    def in_rect(self, rect, margin=0):
+        # фигуры, чьи рамки с запасом margin пересекают rect, в порядке отрисовки
+        found = self.index.query((rect.left() - margin, rect.top() - margin,
+                                  rect.right() + margin, rect.bottom() + margin))
+        if len(found) * 4 > len(self._z):
+            return [s for s in self if s in found]
+        return sorted(found, key=self._z.__getitem__)
+
+    def ordered(self, shapes):
+        z = self._z
+        return sorted((s for s in shapes if s in z), key=z.__getitem__)
+
+    def __contains__(self, shape):
+        return shape in self._z
 
     def __iter__(self):
-        return iter(self._items)
+        return chain(reversed(self._back), self._front)
 
     def __reversed__(self):
-        return reversed(self._items)
+        return chain(reversed(self._front), self._back)
 
     def __len__(self):
-        return len(self._items)
+        return len(self._z)
+
+
+class TileCache:
+    TILE = 256
+
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget
+        self._tiles = OrderedDict()
+        self._damage = {}
+        self._bytes = 0
+        self._ratio = 1.0
+
+    def keys(self, rect):
+        t = self.TILE
+        for row in range(rect.top() // t, rect.bottom() // t + 1):
+            for col in range(rect.left() // t, rect.right() // t + 1):
+                yield col, row
+
+    def invalidate(self, rect):
+        for key in self.keys(rect):
+            if key in self._tiles:
+                old = self._damage.get(key)
+                self._damage[key] = rect if old is None else old.united(rect)
+
+    def clear(self):
+        self._tiles.clear()
+        self._damage.clear()
+        self._bytes = 0
+
+    def tile(self, key, ratio, render):
+        # готовая плитка перерисовывается только в накопленной области повреждений
+        if ratio != self._ratio:
+            self.clear()
+            self._ratio = ratio
+        t = self.TILE
+        bounds = QRect(key[0] * t, key[1] * t, t, t)
+        pm = self._tiles.get(key)
+        if pm is None:
+            side = math.ceil(t * ratio)
+            pm = QPixmap(side, side)
+            pm.setDevicePixelRatio(ratio)
+            self._tiles[key] = pm
+            self._bytes += side * side * 4
+            while self._bytes > self.budget and len(self._tiles) > 1:
+                old_key, old = self._tiles.popitem(last=False)
+                self._damage.pop(old_key, None)
+                self._bytes -= old.width() * old.height() * 4
+            dirty = bounds
+        else:
+            self._tiles.move_to_end(key)
+            dirty = self._damage.pop(key, None)
+            if dirty is None or not dirty.intersects(bounds):
+                return pm
+            dirty = dirty.intersected(bounds)
+        p = QPainter(pm)
+        p.translate(-bounds.x(), -bounds.y())
+        p.setClipRect(dirty)
+        render(p, dirty)
+        p.end()
+        return pm
 
 
 class Shape:
     HANDLE_SIZE = 12
+    PAINT_MARGIN = 8
 
     def __init__(self, color=None):
         if isinstance(color, QColor):
@@ -40,14 +330,64 @@ class Shape:
         if not self.color.isValid():
             self.color = QColor("#000000")
 
+        self.storage = None
+        self.invalidate()
         self.selected = False
 
-    def draw(self, p: QPainter):
+    @property
+    def selected(self):
+        return self._selected
+
+    @selected.setter
+    def selected(self, value):
+        self._selected = value
+        if self.storage is not None:
+            self.storage.changed(self)
+
+    def changed(self):
+        # после move_by / resize: кэши геометрии сбрасываются, хранилище обновляет индексы
+        self.invalidate()
+        if self.storage is not None:
+            self.storage.changed(self)
+
+    def invalidate(self):
+        self._bounds = None
+        self._paint_rect = None
+        self._handles = None
+        self._handle_rects = None
+
+    def draw(self, painter: QPainter):
+        painter.setPen(self.pen(self.color))
+        painter.setBrush(QBrush(self.color) if self.selected else QBrush())
+        self.draw_batch(painter, [self.batch_item()])
+        self.draw_handles(painter)
+
+    @staticmethod
+    def pen(color):
+        return QPen(color, 3)
+
+    def batch_item(self):
+        raise NotImplementedError
+
+    @staticmethod
+    def draw_batch(painter, items):
         raise NotImplementedError
 
     def bounding_rect(self) -> QRect:
+        if self._bounds is None:
+            self._bounds = self.bounds()
+        return self._bounds
+
+    def bounds(self) -> QRect:
         raise NotImplementedError
 
+    def paint_rect(self) -> QRect:
+        # рамка + ручки выделения (HANDLE_SIZE / 2) + перо
+        if self._paint_rect is None:
+            m = self.PAINT_MARGIN
+            self._paint_rect = self.bounding_rect().adjusted(-m, -m, m, m)
+        return self._paint_rect
+
     def contains(self, p: QPoint) -> bool:
         raise NotImplementedError
 
@@ -58,6 +398,17 @@ class Shape:
         raise NotImplementedError
 
     def handles(self):
+        if self._handles is None:
+            self._handles = self.handle_points()
+        return self._handles
+
+    def handle_rects(self):
+        if self._handle_rects is None:
+            hs = self.HANDLE_SIZE
+            self._handle_rects = [QRect(h.x() - hs // 2, h.y() - hs // 2, hs, hs) for h in self.handles()]
+        return self._handle_rects
+
+    def handle_points(self):
         r = self.bounding_rect()
         c = r.center()
         return [
@@ -71,9 +422,7 @@ class Shape:
             return
         painter.setBrush(QBrush(Qt.GlobalColor.white))
         painter.setPen(QPen(Qt.GlobalColor.black, 2))
-        hs = self.HANDLE_SIZE
-        for h in self.handles():
-            rect = QRect(h.x() - hs // 2, h.y() - hs // 2, hs, hs)
+        for rect in self.handle_rects():
             painter.drawRect(rect)
 
 
@@ -83,14 +432,22 @@ class Circle(Shape):
         self.center = QPoint(center)
         self.radius = int(radius)
 
-    def draw(self, painter: QPainter):
-        pen = QPen(self.color, 3)
-        painter.setPen(pen)
-        painter.setBrush(QBrush(self.color) if self.selected else QBrush())
-        painter.drawEllipse(self.center, self.radius, self.radius)
-        self.draw_handles(painter)
+    def invalidate(self):
+        super().invalidate()
+        self._ellipse = None
 
-    def bounding_rect(self) -> QRect:
+    def batch_item(self):
+        if self._ellipse is None:
+            r = self.radius
+            self._ellipse = QRect(self.center.x() - r, self.center.y() - r, r * 2, r * 2)
+        return self._ellipse
+
+    @staticmethod
+    def draw_batch(painter, items):
+        for rect in items:
+            painter.drawEllipse(rect)
+
+    def bounds(self) -> QRect:
         r = self.radius + 10
         return QRect(self.center.x() - r, self.center.y() - r, r * 2, r * 2)
 
@@ -103,6 +460,7 @@ class Circle(Shape):
         nr = self.bounding_rect().translated(dx, dy)
         if canvas.rect().contains(nr):
             self.center += QPoint(dx, dy)
+            self.changed()
             return True
         return False
 
@@ -121,6 +479,7 @@ class Circle(Shape):
                    (new_radius + 10) * 2, (new_radius + 10) * 2)
         if canvas.rect().contains(nr):
             self.radius = new_radius
+            self.changed()
 
 
 class Rectangle(Shape):
@@ -128,22 +487,24 @@ class Rectangle(Shape):
         super().__init__(color)
         self.rect = QRect(x, y, w, h)
 
-    def draw(self, painter: QPainter):
-        painter.setPen(QPen(self.color, 3))
-        painter.setBrush(QBrush(self.color) if self.selected else QBrush())
-        painter.drawRect(self.rect)
-        self.draw_handles(painter)
+    def batch_item(self):
+        return self.rect
 
-    def bounding_rect(self) -> QRect:
+    @staticmethod
+    def draw_batch(painter, items):
+        painter.drawRects(items)
+
+    def bounds(self) -> QRect:
         return self.rect.adjusted(-10, -10, 10, 10)
 
     def contains(self, p: QPoint) -> bool:
-        return self.rect.adjusted(-10, -10, 10, 10).contains(p)
+        return self.bounding_rect().contains(p)
 
     def move_by(self, dx, dy, canvas) -> bool:
         nr = self.bounding_rect().translated(dx, dy)
         if canvas.rect().contains(nr):
             self.rect.translate(dx, dy)
+            self.changed()
             return True
         return False
 
@@ -173,6 +534,7 @@ class Rectangle(Shape):
 
         if canvas.rect().contains(nr.adjusted(-10, -10, 10, 10)):
             self.rect = nr
+            self.changed()
 
 
 class Triangle(Shape):
@@ -185,28 +547,40 @@ class Triangle(Shape):
             QPoint(center.x() + s, center.y() + s)
         ]
 
-    def draw(self, painter: QPainter):
-        painter.setPen(QPen(self.color, 3))
-        painter.setBrush(QBrush(self.color) if self.selected else QBrush())
-        painter.drawPolygon(QPolygon(self.points))
-        self.draw_handles(painter)
+    def invalidate(self):
+        super().invalidate()
+        self._polygon = None
 
-    def bounding_rect(self) -> QRect:
-        return QPolygon(self.points).boundingRect().adjusted(-10, -10, 10, 10)
+    def polygon(self) -> QPolygon:
+        if self._polygon is None:
+            self._polygon = QPolygon(self.points)
+        return self._polygon
+
+    def batch_item(self):
+        return self.polygon()
+
+    @staticmethod
+    def draw_batch(painter, items):
+        for polygon in items:
+            painter.drawPolygon(polygon)
+
+    def bounds(self) -> QRect:
+        return self.polygon().boundingRect().adjusted(-10, -10, 10, 10)
 
     def contains(self, p: QPoint) -> bool:
-        return QPolygon(self.points).containsPoint(p, Qt.FillRule.OddEvenFill)
+        return self.polygon().containsPoint(p, Qt.FillRule.OddEvenFill)
 
     def move_by(self, dx, dy, canvas) -> bool:
         np = [p + QPoint(dx, dy) for p in self.points]
-        nr = QPolygon(np).boundingRect().adjusted(-10, -10, 10, 10)
+        nr = self.bounding_rect().translated(dx, dy)
         if canvas.rect().contains(nr):
             self.points = np
+            self.changed()
             return True
         return False
 
     def resize(self, idx, delta, canvas):
-        old = QPolygon(self.points).boundingRect()
+        old = self.polygon().boundingRect()
         new = QRect(old)
 
         if idx == 0:   new.setTopLeft(old.topLeft() + delta)
@@ -238,34 +612,58 @@ class Triangle(Shape):
             pts.append(QPoint(int(nx), int(ny)))
 
         self.points = pts
+        self.changed()
 
 
 class LineSegment(Shape):
+    MIN_LENGTH = 10
+
     def __init__(self, p1: QPoint, p2: QPoint, color=None):
         super().__init__(color)
         self.p1 = QPoint(p1)
         self.p2 = QPoint(p2)
 
-    def draw(self, painter: QPainter):
-        painter.setPen(QPen(self.color, 4, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap))
-        painter.drawLine(self.p1, self.p2)
-        self.draw_handles(painter)
+    def invalidate(self):
+        super().invalidate()
+        self._line = None
 
-    def bounding_rect(self) -> QRect:
+    def line(self) -> QLine:
+        if self._line is None:
+            self._line = QLine(self.p1, self.p2)
+        return self._line
+
+    @staticmethod
+    def pen(color):
+        return QPen(color, 4, Qt.PenStyle.SolidLine, Qt.PenCapStyle.RoundCap)
+
+    def batch_item(self):
+        return self.line()
+
+    @staticmethod
+    def draw_batch(painter, items):
+        painter.drawLines(items)
+
+    def bounds(self) -> QRect:
         return QRect(self.p1, self.p2).normalized().adjusted(-15, -15, 15, 15)
 
-    def handles(self):
+    def handle_points(self):
         return [self.p1, self.p2]
 
     def contains(self, p: QPoint) -> bool:
-        return QLineF(self.p1, self.p2).distanceToPoint(p) <= 10
+        x1, y1 = self.p1.x(), self.p1.y()
+        dx, dy = self.p2.x() - x1, self.p2.y() - y1
+        px, py = p.x() - x1, p.y() - y1
+        length = dx * dx + dy * dy
+        t = max(0, min(1, (px * dx + py * dy) / length)) if length else 0
+        return math.hypot(px - t * dx, py - t * dy) <= 10
 
     def move_by(self, dx, dy, canvas) -> bool:
         np1 = self.p1 + QPoint(dx, dy)
         np2 = self.p2 + QPoint(dx, dy)
-        nr = QRect(np1, np2).normalized().adjusted(-15, -15, 15, 15)
+        nr = self.bounding_rect().translated(dx, dy)
         if canvas.rect().contains(nr):
             self.p1, self.p2 = np1, np2
+            self.changed()
             return True
         return False
 
@@ -276,54 +674,162 @@ class LineSegment(Shape):
         else:
             self.p2 += delta
         nr = QRect(self.p1, self.p2).normalized().adjusted(-15, -15, 15, 15)
-        if not canvas.rect().contains(nr):
+        # концы не сходятся в точку: у линии нулевой длины нет направления для ручек
+        if (self.p2 - self.p1).manhattanLength() < self.MIN_LENGTH or not canvas.rect().contains(nr):
             self.p1, self.p2 = old1, old2
+            return
+        self.changed()
+
+
+class ShapeBatches:
+    # пачки по (класс, цвет, выделение); фигура догоняет свою пачку, только если
+    # в её ячейках после этой пачки ничего не рисовалось - z-порядок перекрытий сохраняется
+    CELL = 64
+    ROW = 1 << 20
+
+    def __init__(self):
+        self.batches = []
+        self.open = {}
+        self.top = {}
+        self.handles = []
+
+    def add(self, s):
+        key = (type(s), s.color.rgba(), s.selected)
+        r = s.paint_rect()
+        c, step = self.CELL, self.ROW
+        col = r.left() // c
+        cols = range(col, r.right() // c + 1)
+        rows = range(step * (r.top() // c), step * (r.bottom() // c) + 1, step)
+        top = self.top
+        get = top.get
+        last = 0
+        for row in rows:
+            for cell in cols:
+                t = get(row + cell, 0)
+                if t > last:
+                    last = t
+        index = self.open.get(key)
+        if index is None or index < last - 1:
+            index = self.open[key] = len(self.batches)
+            self.batches.append((type(s), QColor(s.color), s.selected, []))
+        self.batches[index][3].append(s.batch_item())
+        index += 1
+        for row in rows:
+            for cell in cols:
+                top[row + cell] = index
+        if s.selected:
+            self.handles.extend(s.handle_rects())
+
+    def draw(self, p):
+        for kind, color, selected, items in self.batches:
+            p.setPen(kind.pen(color))
+            p.setBrush(QBrush(color) if selected else QBrush())
+            kind.draw_batch(p, items)
+        # ручки выделения - одним проходом поверх всех фигур
+        if self.handles:
+            p.setBrush(QBrush(Qt.GlobalColor.white))
+            p.setPen(QPen(Qt.GlobalColor.black, 2))
+            p.drawRects(self.handles)
 
 
 class Canvas(QWidget):
+    failed = pyqtSignal(str, str)
+
     def __init__(self):
         super().__init__()
         self.setFocusPolicy(Qt.FocusPolicy.StrongFocus)
         self.storage = ShapeStorage()
+        self.storage.on_failure = self.failed.emit
         self.current_color = QColor("#0066ff")
         self.current_shape_type = "circle"
         self.drag_start = None
         self.selected_shapes = set()
         self.resize_handle = -1
+        self.tiles = TileCache()
+        self.drag_layer = None
+        self.drag_shapes = []
+        self.drag_set = set()
+        self.drag_holes = []
 
     def paintEvent(self, event):
         p = QPainter(self)
+        if self.drag_layer is not None:
+            # во время перетаскивания: снятый фон + только выделенные фигуры
+            p.drawPixmap(0, 0, self.drag_layer)
+            p.setRenderHint(QPainter.RenderHint.Antialiasing)
+            batches = ShapeBatches()
+            for s in self.drag_shapes:
+                if self.area(s).intersects(event.rect()):
+                    batches.add(s)
+            batches.draw(p)
+            return
+        self.draw_tiles(p, event.rect())
+
+    def draw_tiles(self, p, rect):
+        ratio = self.devicePixelRatioF()
+        t = TileCache.TILE
+        for key in self.tiles.keys(rect):
+            p.drawPixmap(key[0] * t, key[1] * t, self.tiles.tile(key, ratio, self.render_tile))
+
+    def render_tile(self, p, rect, skip=(), region=None):
         p.setRenderHint(QPainter.RenderHint.Antialiasing)
-        p.fillRect(self.rect(), QColor("#fafafa"))
-        for s in self.storage:
-            try:
-                s.draw(p)
-            except:
-                pass
+        p.fillRect(rect, QColor("#fafafa"))
+        batches = ShapeBatches()
+        for s in self.storage.in_rect(rect, Shape.PAINT_MARGIN):
+            if s not in skip and (region or rect).intersects(self.area(s)):
+                batches.add(s)
+        batches.draw(p)
+
+    @staticmethod
+    def area(s):
+        return s.paint_rect()
+
+    def damage(self, shapes):
+        if self.drag_layer is not None and not self.drag_set.issuperset(shapes):
+            self.end_drag()
+        for s in shapes:
+            r = self.area(s)
+            if self.drag_layer is None:
+                self.tiles.invalidate(r)
+            self.update(r)
+
+    def begin_drag(self):
+        self.drag_shapes = self.storage.ordered(self.selected_shapes)
+        if not self.drag_shapes:
+            return
+        self.drag_set = set(self.drag_shapes)
+        ratio = self.devicePixelRatioF()
+        layer = QPixmap(math.ceil(self.width() * ratio), math.ceil(self.height() * ratio))
+        layer.setDevicePixelRatio(ratio)
+        p = QPainter(layer)
+        self.draw_tiles(p, self.rect())
+        self.drag_holes = []
+        holes = QRegion()
+        for s in self.drag_shapes:
+            r = self.area(s)
+            self.drag_holes.append(r)
+            holes = holes.united(r)
+        # места под выделенными фигурами перерисовываются без них за один проход
+        p.setClipRegion(holes)
+        self.render_tile(p, holes.boundingRect(), self.drag_set, holes)
+        p.end()
+        self.drag_layer = layer
+
+    def end_drag(self):
+        if self.drag_layer is None:
+            return
+        self.drag_layer = None
+        for r in self.drag_holes:
+            self.tiles.invalidate(r)
+        self.damage(self.drag_shapes)
+        self.drag_shapes, self.drag_set, self.drag_holes = [], set(), []
+        self.update()
 
     def mousePressEvent(self, event):
         if event.button() != Qt.MouseButton.LeftButton:
             return
         pos = event.pos()
-        hit = None
-        handle_idx = None
-
-        for s in reversed(list(self.storage)):
-            if s.selected:
-                for i, h in enumerate(s.handles()):
-                    hs = Shape.HANDLE_SIZE
-                    if QRect(h.x() - hs//2, h.y() - hs//2, hs, hs).contains(pos):
-                        hit = s
-                        handle_idx = i
-                        break
-                if handle_idx is not None:
-                    break
-            try:
-                if s.contains(pos):
-                    hit = s
-                    break
-            except:
-                continue
+        hit, handle_idx = self.storage.hit(pos)
 
         ctrl = bool(event.modifiers() & Qt.KeyboardModifier.ControlModifier)
 
@@ -345,45 +851,43 @@ class Canvas(QWidget):
                 shape = Triangle(pos, 60, self.current_color)
             else:
                 shape = LineSegment(QPoint(pos.x()-60, pos.y()), QPoint(pos.x()+60, pos.y()), self.current_color)
-            self.storage.add(shape)
-            self.select_shape(shape)
+            if self.storage.add(shape):
+                self.select_shape(shape)
 
         self.drag_start = pos
         self.resize_handle = handle_idx if handle_idx is not None else -1
-        self.update()
 
     def mouseMoveEvent(self, event):
         if self.drag_start is None:
             return
 
         delta = event.pos() - self.drag_start
+        if self.drag_layer is None:
+            self.begin_drag()
+        self.damage(self.selected_shapes)
 
         if self.resize_handle != -1:
-            for shape in list(self.selected_shapes):
-                try:
-                    shape.resize(self.resize_handle, delta, self)
-                except:
-                    pass
+            for shape in self.selected_shapes:
+                shape.resize(self.resize_handle, delta, self)
         else:
             for shape in list(self.selected_shapes):
-                try:
-                    shape.move_by(delta.x(), delta.y(), self)
-                except:
-                    pass
+                shape.move_by(delta.x(), delta.y(), self)
 
         self.drag_start = event.pos()
-        self.update()
+        self.damage(self.selected_shapes)
 
     def mouseReleaseEvent(self, event):
         self.drag_start = None
         self.resize_handle = -1
+        self.end_drag()
 
     def keyPressEvent(self, event):
         if event.key() == Qt.Key.Key_Delete and self.selected_shapes:
+            self.end_drag()
+            self.damage(self.selected_shapes)
             for s in list(self.selected_shapes):
                 self.storage.remove(s)
             self.deselect_all()
-            self.update()
             return
 
         if not self.selected_shapes:
@@ -398,23 +902,24 @@ class Canvas(QWidget):
         elif event.key() == Qt.Key.Key_Down: dy = step
 
         if dx or dy:
+            self.damage(self.selected_shapes)
             for s in list(self.selected_shapes):
-                try:
-                    s.move_by(dx, dy, self)
-                except:
-                    pass
-            self.update()
+                s.move_by(dx, dy, self)
+            self.damage(self.selected_shapes)
 
     def select_shape(self, shape):
         shape.selected = True
         self.selected_shapes.add(shape)
+        self.damage([shape])
 
     def deselect_all(self):
+        self.damage(self.selected_shapes)
         for s in list(self.selected_shapes):
             s.selected = False
         self.selected_shapes.clear()
 
     def toggle_selection(self, shape):
+        self.damage([shape])
         if shape in self.selected_shapes:
             shape.selected = False
             self.selected_shapes.remove(shape)
@@ -428,6 +933,14 @@ class Canvas(QWidget):
             self.select_shape(s)
         self.update()
 
+    def bring_to_front(self):
+        self.storage.bring_to_front(self.selected_shapes)
+        self.damage(self.selected_shapes)
+
+    def send_to_back(self):
+        self.storage.send_to_back(self.selected_shapes)
+        self.damage(self.selected_shapes)
+
 
 class MainWindow(QMainWindow):
     def __init__(self):
@@ -441,6 +954,9 @@ class MainWindow(QMainWindow):
         self.setCentralWidget(central)
         self.create_toolbar()
         self.create_menu()
+        self.failures_label = QLabel()
+        self.statusBar().addPermanentWidget(self.failures_label)
+        self.canvas.failed.connect(self.show_failure)
 
     def create_toolbar(self):
         tb = QToolBar("Инструменты")
@@ -469,6 +985,30 @@ class MainWindow(QMainWindow):
         a.setShortcut(QKeySequence.StandardKey.SelectAll)
         a.triggered.connect(self.canvas.select_all)
         edit.addAction(a)
+        a = QAction("На передний план", self)
+        a.setShortcut(QKeySequence("Ctrl+]"))
+        a.triggered.connect(self.canvas.bring_to_front)
+        edit.addAction(a)
+        a = QAction("На задний план", self)
+        a.setShortcut(QKeySequence("Ctrl+["))
+        a.triggered.connect(self.canvas.send_to_back)
+        edit.addAction(a)
+        a = QAction("Сбои фигур", self)
+        a.triggered.connect(self.show_failures)
+        edit.addAction(a)
+
+    def show_failure(self, source, error):
+        self.failures_label.setText(f"Сбоев: {self.canvas.storage.failures.total()}")
+        self.statusBar().showMessage(f"{source}: {error}", 5000)
+
+    def show_failures(self):
+        storage = self.canvas.storage
+        if not storage.failures:
+            QMessageBox.information(self, "Сбои фигур", "Сбоев нет")
+            return
+        counts = "\n".join(f"{source}: {n}" for source, n in storage.failures.most_common())
+        last = "\n".join(f"{source}: {error}" for source, error, shape in reversed(storage.rejected))
+        QMessageBox.warning(self, "Сбои фигур", f"{counts}\n\nПоследние:\n{last}")
 
     def choose_color(self):
         try:
@@ -478,11 +1018,8 @@ class MainWindow(QMainWindow):
             nc = QColor(c)
             self.canvas.current_color = QColor(nc)
             for s in list(self.canvas.selected_shapes):
-                try:
-                    s.color = QColor(nc)
-                except:
-                    pass
-            self.canvas.update()
+                s.color = QColor(nc)
+            self.canvas.damage(self.canvas.selected_shapes)
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", str(e))
 